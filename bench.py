@@ -0,0 +1,533 @@
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+from requests.adapters import HTTPAdapter
+
+import http_client
+import media
+from bot import BotClass
+from catalog import Catalog
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+logger = logging.getLogger("bot")
+root = os.path.dirname(os.path.abspath(__file__))
+sources = ("twitter", "danbooru", "pixiv", "other")
+
+
+def png(name, size=64):
+    """
+    :param name: string the pixels are generated from, the same name
+                 always gives the same image
+    :return: bytes of a png with random pixels
+    """
+    pixels = random.Random(name).randbytes(size * size * 3)
+    if Image is None:
+        # only the header is checked without Pillow
+        return b"\x89PNG\r\n\x1a\n" + pixels
+    data = io.BytesIO()
+    Image.frombytes("RGB", (size, size), pixels).save(data, "PNG")
+    return data.getvalue()
+
+
+def synthetic_images(count, paths, seed=0):
+    """
+    :param count: number of images to generate
+    :param paths: list of strings with paths to existing image files
+    :param seed: seed for the random generator
+    :return: list of dictionaries following schema/image.json
+    """
+    rand = random.Random(seed)
+    images = []
+    for index in range(count):
+        kind = sources[index % len(sources)]
+        if kind == "twitter":
+            source = "https://twitter.com/artist{}/status/{}".format(
+                index % 997, 10 ** 17 + index)
+        elif kind == "danbooru":
+            source = "https://danbooru.donmai.us/posts/{}".format(index)
+        elif kind == "pixiv":
+            source = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id={}".format(
+                index)
+        else:
+            source = "https://example.com/art/{}".format(index)
+        image = {
+            "source": source,
+            "image_paths": rand.sample(paths, rand.randint(1, min(4, len(paths)))),
+            "author": {
+                "handle": "@artist{}@twitter.com".format(index % 997),
+                "name": "artist {}".format(index % 997)
+            },
+            "description": "#tag{} #tag{}".format(index % 31, index % 57),
+            "nsfw": rand.random() < 0.1,
+            "phashes": ["{:016x}".format(rand.getrandbits(64))]
+        }
+        if rand.random() < 0.2:
+            image["posted"] = "https://mastodon.bench/@bot/{}".format(index)
+        images.append(image)
+    return images
+
+
+class FakeServer(ThreadingHTTPServer):
+    """
+    answers like mastodon, danbooru, pixiv, twitter and their file hosts,
+    every request counts and waits latency seconds
+    """
+
+    daemon_threads = True
+
+    def __init__(self, latency=0, handler=None):
+        super().__init__(("127.0.0.1", 0), handler or FakeHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.requests = 0
+        self.files = {"big.mp4": b"\x00\x00\x00\x18ftypmp42" + os.urandom(32 * 1024 * 1024)}
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return str(self.counter)
+
+    def file(self, name):
+        if name not in self.files:
+            self.files[name] = png(name)
+        return self.files[name]
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    instance = {
+        "uri": "mastodon.bench",
+        "title": "bench",
+        "version": "4.2.0",
+        "configuration": {
+            "media_attachments": {
+                "image_size_limit": 8 * 1024 * 1024,
+                "video_size_limit": 40 * 1024 * 1024,
+                "image_matrix_limit": 3840 * 2160
+            }
+        }
+    }
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_file(self, data, content_type):
+        start = 0
+        etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+        match = re.match(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match and self.headers.get("If-Range", etag) == etag:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def handle_request(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        length = int(self.headers.get("Content-Length", 0))
+        if length:
+            self.rfile.read(length)
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        # mastodon
+        if path in ("/api/v1/instance", "/api/v2/instance"):
+            return self.send_json(self.instance)
+        if path in ("/api/v1/media", "/api/v2/media"):
+            return self.send_json({"id": server.next_id(), "type": "image"})
+        if path == "/api/v1/statuses":
+            id = server.next_id()
+            return self.send_json(
+                {"id": id, "url": "https://mastodon.bench/@bot/" + id})
+        match = re.match(r"/api/v1/statuses/(\d+)/reblog$", path)
+        if match:
+            id = server.next_id()
+            return self.send_json(
+                {"id": id, "url": "https://mastodon.bench/@bot/" + id,
+                 "reblog": {"id": match.group(1)}})
+        if path == "/api/v2/search":
+            return self.send_json({"accounts": [], "hashtags": [],
+                                   "statuses": [{"id": server.next_id()}]})
+
+        # danbooru
+        match = re.match(r"/posts/(\d+)\.json$", path)
+        if match:
+            id = match.group(1)
+            return self.send_json({
+                "id": int(id),
+                "file_url": "/data/{}.png".format(id),
+                "source": "",
+                "pixiv_id": None,
+                "tag_string_artist": "artist_" + id,
+                "tag_string_copyright": "original",
+                "rating": "s"
+            })
+
+        # twitter
+        if path == "/1.1/statuses/show.json":
+            id = query["id"]
+            return self.send_json({
+                "id_str": id,
+                "text": "tweet {} https://t.co/x".format(id),
+                "possibly_sensitive": False,
+                "user": {"screen_name": "artist", "name": "artist"},
+                "extended_entities": {"media": [{
+                    "type": "photo",
+                    "media_url_https": "https://pbs.twimg.com/media/{}.png".format(id)
+                }]}
+            })
+
+        # pixiv
+        if path == "/v1/illust/detail":
+            id = query["illust_id"]
+            return self.send_json({"illust": {
+                "id": int(id),
+                "title": "illust " + id,
+                "image_urls": {"large": "https://i.pximg.net/img/{}.png".format(id)},
+                "user": {"id": 1, "name": "artist"},
+                "tags": [{"name": "tag"}]
+            }})
+        if path == "/v1/user/detail":
+            return self.send_json({"profile": {"twitter_account": "artist",
+                                               "pawoo_url": None}})
+
+        # file hosts
+        name = posixpath_name(path)
+        if name.endswith(".mp4"):
+            return self.send_file(server.file(name), "video/mp4")
+        if name.endswith(".png"):
+            return self.send_file(server.file(name), "image/png")
+        self.send_json({"error": "not found"}, status=404)
+
+    do_GET = handle_request
+    do_POST = handle_request
+    do_PUT = handle_request
+
+
+def posixpath_name(path):
+    return path.rsplit("/", 1)[-1]
+
+
+class LocalAdapter(HTTPAdapter):
+    """
+    sends every request to the fake server, whatever host it was meant for
+    """
+
+    def __init__(self, address):
+        super().__init__()
+        self.address = address
+
+    def send(self, request, **kwargs):
+        parts = urlsplit(request.url)
+        request.url = urlunsplit(
+            ("http", self.address, parts.path, parts.query, parts.fragment))
+        return super().send(request, **kwargs)
+
+
+class FakeTwitter():
+    """
+    stands in for tweepy, statuses come from the fake server
+    """
+
+    class Status():
+        def __init__(self, data):
+            self._json = data
+
+    def get_status(self, id):
+        response = http_client.session.get(
+            "https://api.twitter.com/1.1/statuses/show.json", params={"id": id})
+        return self.Status(response.json())
+
+
+class FakePixiv():
+    """
+    stands in for pixivpy, illusts come from the fake server
+    """
+
+    def illust_detail(self, id, req_auth=True):
+        return http_client.session.get(
+            "https://app-api.pixiv.net/v1/illust/detail",
+            params={"illust_id": id}).json()
+
+    def user_detail(self, id, req_auth=True):
+        return http_client.session.get(
+            "https://app-api.pixiv.net/v1/user/detail",
+            params={"user_id": id}).json()
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"], cwd=root,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark():
+    """
+    runs the bot against fake servers and collects the timings
+    """
+
+    def __init__(self, directory, server, repeat=3):
+        self.directory = directory
+        self.server = server
+        self.repeat = repeat
+        self.results = []
+        media.store = media.MediaStore(os.path.join(directory, "images"))
+        self.paths = [media.store.write(png("file{}".format(i)), ".png")
+                      for i in range(8)]
+
+    def config(self, name):
+        return {
+            "name": "bench",
+            "access_token": "token",
+            "client_id": "id",
+            "client_secret": "secret",
+            "domain": "https://mastodon.bench",
+            "db_path": os.path.join(self.directory, name + ".sqlite"),
+            "respond": False,
+            "offset_min": 10
+        }
+
+    def bot(self, name):
+        bot = BotClass(self.config(name))
+        # cached_property values live in the instance dictionary
+        bot.__dict__["tweet_api"] = FakeTwitter()
+        bot.__dict__["pixiv_api"] = FakePixiv()
+        bot.__dict__["danbooru_api"] = False
+        return bot
+
+    def measure(self, name, function, size, operations=1, setup=None):
+        """
+        :param name: string naming the benchmark
+        :param function: function to time
+        :param size: number of images in the db
+        :param operations: number of operations one call of function does
+        :param setup: function called before every run, not timed
+        """
+        timings = []
+        for _ in range(self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        result = {
+            "name": name,
+            "images": size,
+            "operations": operations,
+            "seconds": best,
+            "mean_seconds": sum(timings) / len(timings),
+            "per_second": operations / best if best else None
+        }
+        logger.warning("{name} ({images} images): {seconds:.4f}s".format(**result))
+        self.results.append(result)
+        return result
+
+    def run_db(self, size, posts=20, lookups=10000, picks=10000):
+        images = synthetic_images(size, self.paths)
+        name = "db{}".format(size)
+        bot = self.bot(name)
+
+        def bulk_add():
+            bot.storage.connection.execute("DELETE FROM images")
+            bot.storage.connection.commit()
+            bot.load_images()
+            for start in range(0, size, 1000):
+                bot.add_image(*images[start:start + 1000])
+        self.measure("add_image", bulk_add, size, operations=size)
+
+        def cold_load():
+            bot.storage.version = None
+            bot.load_images()
+        self.measure("load_images", cold_load, size)
+        self.measure("load_images_unchanged", bot.load_images, size)
+
+        # memory the db takes as plain dictionaries, as catalog and
+        # everything a loaded bot keeps, including its indexes
+        tracemalloc.start()
+        loaded = bot.storage.load()
+        dictionaries = tracemalloc.get_traced_memory()[0]
+        catalog = Catalog(bot.storage.get)
+        catalog.extend(loaded)
+        del loaded
+        compact = tracemalloc.get_traced_memory()[0]
+        del catalog
+        # the images are streamed, so the peak of a load only adds one
+        # validation batch of dictionaries to what the bot keeps
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        # a new bot loads the db when it starts
+        loading = self.bot(name)
+        loading.load_images()
+        retained = tracemalloc.get_traced_memory()[0] - before
+        peak = tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        loading.storage.close()
+        loading.cache.close()
+        del loading
+        for name, used in (("dictionaries_bytes", dictionaries), ("catalog_bytes", compact),
+                           ("bot_bytes", retained), ("load_peak_bytes", peak)):
+            self.results.append({"name": name, "images": size,
+                                 "bytes": used, "bytes_per_image": used / size})
+
+        queries = [image["source"] for image in random.Random(1).choices(
+            images, k=lookups // 2)]
+        queries += ["https://example.com/missing/{}".format(i)
+                    for i in range(lookups - len(queries))]
+
+        def exists():
+            for source in queries:
+                bot.image_exists(source)
+        self.measure("image_exists", exists, size, operations=lookups)
+
+        def choose():
+            for _ in range(picks):
+                bot.selector.choose()
+        self.measure("choose", choose, size, operations=picks)
+
+        def post():
+            for _ in range(posts):
+                bot.post_toot()
+        self.measure("post_toot", post, size, operations=posts)
+        bot.storage.close()
+        bot.cache.close()
+
+    def run_import(self, count, workers):
+        bot = self.bot("import")
+        round = [0]
+
+        def setup():
+            bot.storage.connection.execute("DELETE FROM images")
+            bot.storage.connection.commit()
+            bot.load_images()
+            round[0] += 1
+
+        def run():
+            # new ids every round so the files and api responses aren't cached
+            offset = round[0] * count
+            urls = []
+            for index in range(offset, offset + count):
+                kind = sources[index % 3]
+                if kind == "twitter":
+                    urls.append("https://twitter.com/artist/status/{}".format(index))
+                elif kind == "danbooru":
+                    urls.append("https://danbooru.donmai.us/posts/{}".format(index))
+                else:
+                    urls.append("https://www.pixiv.net/member_illust.php"
+                                "?mode=medium&illust_id={}".format(index))
+            added, skipped, failed = bot.import_images(urls, workers=workers)
+            if failed:
+                logger.warning("{} sources failed to import".format(failed))
+        self.measure("import_images", run, 0, operations=count, setup=setup)
+        bot.storage.close()
+        bot.cache.close()
+
+    def run_download(self):
+        size = len(self.server.files["big.mp4"])
+
+        def download():
+            path = media.store.download("https://files.bench/big.mp4")
+            os.remove(path)
+        result = self.measure("download", download, 0, operations=1)
+        result["megabytes_per_second"] = size / 1024 / 1024 / result["seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='benchmark the bot against local fake servers')
+    parser.add_argument("-s", "--sizes", help="comma separated db sizes",
+                        default="1000,10000,100000")
+    parser.add_argument("-r", "--repeat", help="runs of every benchmark, the fastest counts",
+                        type=int, default=3)
+    parser.add_argument("-i", "--imports", help="number of sources imported",
+                        type=int, default=60)
+    parser.add_argument("-w", "--workers", help="number of sources imported at the same time",
+                        type=int, default=8)
+    parser.add_argument("-l", "--latency", help="milliseconds the fake servers wait per request",
+                        type=float, default=0)
+    parser.add_argument("-o", "--output", help="write the results as json to a file instead of stdout",
+                        metavar="FILE")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    logger.addHandler(logging.StreamHandler())
+    # the schemas are referenced relative to the repository
+    os.chdir(root)
+
+    server = FakeServer(latency=args.latency / 1000)
+    adapter = LocalAdapter("{}:{}".format(*server.server_address))
+    http_client.session.mount("http://", adapter)
+    http_client.session.mount("https://", adapter)
+
+    with tempfile.TemporaryDirectory() as directory:
+        benchmark = Benchmark(directory, server, repeat=args.repeat)
+        for size in args.sizes.split(","):
+            benchmark.run_db(int(size))
+        benchmark.run_import(args.imports, args.workers)
+        benchmark.run_download()
+    server.shutdown()
+
+    report = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "latency_ms": args.latency,
+        "requests": server.requests,
+        "results": benchmark.results
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
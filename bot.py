@@ -1,37 +1,46 @@
 import argparse
+import asyncio
 import datetime
 import logging
 import sys
 import json
-from jsonschema import validate, RefResolver
+from jsonschema import RefResolver, validators
+from jsonschema.exceptions import best_match
 import os
-from collections import namedtuple
-import shutil
-import requests
+from types import SimpleNamespace
 from urllib.parse import urlsplit
-import posixpath
-import re
-import random
+import signal
 import time
-from urllib import parse
-
-import schedule
-from mastodon import Mastodon
-import tweepy
-from pixivpy3 import *
-from pybooru import Danbooru
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, \
+    as_completed
+from functools import cached_property
+import threading
+
+import http_client
+from cache import Cache
+from catalog import Catalog, SourceIndex
+from history import History
+import media
+import metrics
+import outbox
+from outbox import Outbox
+from index import ImageIndex, parse_query
+from responder import Responder
+from media import download_image
+from resolvers import find_resolver, re_danbooru, re_mastodon, re_pixiv_id, \
+    re_tweet, source_type
+from selection import Selector
+from storage import open_storage, migrate
+from watcher import Watcher, sqlite_files
 
 
 logger = logging.getLogger("bot")
-re_twitter = re.compile(r"https?://twitter\.com/\S+/\d+")
-re_tweet = re.compile(r"https?://twitter\.com\/(\S+)/status/\d+")
-re_danbooru = re.compile(r"https?://danbooru\.donmai\.us/posts/\d+")
-re_pixiv = re.compile(
-    r"https?://(www)?.pixiv.net/member_illust\.php\?mode=medium&illust_id=\d+")
-re_mastodon = re.compile(
-    r"https?://(pawoo\.net|mastodon\.social|mstdn\.jp)/\S+/\d+")
-re_link = re.compile(
-    r"^(?:https?://)?[\w.-]+(?:\.[\w\.-]+)+[\w\-\._~:/?#[\]@!\$&'\(\)\*\+,;=.]+$")
+schema_validators = {}
+clients = {}
+clients_lock = threading.Lock()
+# long running jobs like warming caches, kept apart from the default
+# executor so the toots of all bots never wait behind them
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
 
 
 def error_info(e):
@@ -45,41 +54,199 @@ def error_info(e):
     return exc_type, fname, exc_tb.tb_lineno
 
 
-def get_handle(username, domain="twitter.com"):
-    handle = "@{}@{}".format(username, domain)
-    return handle
+def get_validator(schema_path):
+    """
+    compiles every schema only once per process
+    :param schema_path: string with the path to the json schema
+    :return: validator for the schema, refs are resolved relative to its folder
+    """
+    if schema_path not in schema_validators:
+        with open(schema_path) as data:
+            schema = json.load(data)
+        # change relative paths to a absolute paths
+        base_uri = 'file:///{0}/'.format(
+            os.path.dirname(os.path.abspath(schema_path)).replace("\\", '/'))
+        resolver = RefResolver(base_uri, schema)
+        validator = validators.validator_for(schema)
+        validator.check_schema(schema)
+        schema_validators[schema_path] = validator(schema, resolver=resolver)
+    return schema_validators[schema_path]
 
 
-def download_image(url):
+def namespace(value):
     """
-    :param url: string with the url to the image
-    :return: string with the path to the saved image
+    :param value: parsed json
+    :return: the value with all dictionaries turned into namespaces, so
+             settings can be read as attributes
     """
-    domain = "{0.netloc}".format(urlsplit(url))
-    path = urlsplit(url).path
-    filename = posixpath.basename(path)
-
-    logger.info("downloading image...")
-
-    file_path = "images/{}/{}".format(domain, filename)
-    if not os.path.isfile(file_path):
-        # create folders based on domain name
-        if not os.path.isdir("images/" + domain):
-            os.makedirs("images/" + domain)
-
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:20.0) Gecko/20100101 Firefox/20.0'}
-        response = requests.get(url, headers=headers, stream=True)
-
-        with open(file_path, 'wb') as out_file:
-            shutil.copyfileobj(
-                response.raw, out_file)
-        del response
-        logger.info("image downloaded!")
-    else:
-        logger.info("image already downloaded")
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [namespace(item) for item in value]
+    return value
+
+
+def normalize_source(source):
+    """
+    the same post gets the same key under different url spellings
+    :param source: string with the url to the source
+    :return: string that identifies the post
+    """
+    source = source.strip()
+    match = re_tweet.search(source)
+    if match:
+        return "twitter:" + match.group(2)
+    match = re_danbooru.search(source)
+    if match:
+        return "danbooru:" + match.group(1)
+    match = re_pixiv_id.search(source)
+    if match:
+        return "pixiv:" + match.group(1)
+    match = re_mastodon.search(source)
+    if match:
+        return "{}:{}".format(match.group(1), match.group(2))
+    # strip scheme, www, query strings and trailing slashes of other links
+    parts = urlsplit(source if "//" in source else "//" + source)
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return netloc + parts.path.rstrip("/")
+
+
+def shared_client(key, login):
+    """
+    bots running in the same process share api clients with the same
+    credentials
+    :param key: tuple identifying the service and credentials
+    :param login: function creating a new client
+    :return: client for the credentials
+    """
+    with clients_lock:
+        if key not in clients:
+            clients[key] = login()
+        return clients[key]
+
 
-    return file_path
+# api libraries are only imported once they're needed to keep startup fast
+def mastodon_login(settings):
+    from mastodon import Mastodon
+    return Mastodon(client_id=settings.client_id,
+                    client_secret=settings.client_secret,
+                    access_token=settings.access_token,
+                    api_base_url=settings.domain,
+                    session=http_client.session)
+
+
+def twitter_login(account):
+    import tweepy
+    auth = tweepy.OAuthHandler(account.consumer_key,
+                               account.consumer_secret)
+    auth.set_access_token(account.access_token,
+                          account.access_token_secret)
+    return tweepy.API(auth)
+
+
+def danbooru_login(account):
+    from pybooru import Danbooru
+    api = Danbooru('danbooru',
+                   username=account.username,
+                   api_key=account.token)
+    api.client.mount("https://", http_client.retry_adapter())
+    return api
+
+
+def pixiv_login(account, cache):
+    """
+    logs in with a refresh token from an earlier run if possible
+    :param account: pixiv settings from the config
+    :param cache: Cache the refresh token is kept in
+    """
+    from pixivpy3 import AppPixivAPI, PixivError
+    api = AppPixivAPI(timeout=http_client.session.timeout)
+    api.requests.mount("https://", http_client.retry_adapter())
+    key = "pixiv_token:" + account.username
+    refresh_token = cache.get(key)
+    try:
+        if not refresh_token:
+            raise PixivError("no refresh token cached")
+        api.auth(refresh_token=refresh_token)
+    except PixivError:
+        api.login(account.username, account.password)
+    cache.set(key, api.refresh_token)
+    return api
+
+
+def load_bots(directory):
+    """
+    :param directory: string with the path to a folder of config files
+    :return: list of BotClass instances, one for every valid config
+    """
+    bots = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(directory, name)
+        try:
+            with open(path) as data:
+                bots.append(BotClass(json.load(data), path))
+            logger.info("loaded bot " + path)
+        except Exception as e:
+            logger.warning("couldn't load {}: {}".format(path, repr(e)))
+    # spread the first toots of all bots over their interval, so they
+    # don't all hit the instance at the same moment
+    for index, bot in enumerate(bots):
+        bot.delay = index * bot.settings.offset_min * 60 / len(bots)
+    return bots
+
+
+async def sleep_until(timestamp):
+    """
+    :param timestamp: unix time to wait for, returns at once if it passed
+    """
+    remaining = timestamp - time.time()
+    if remaining > 0:
+        await asyncio.sleep(remaining)
+
+
+def in_thread(function, *args):
+    """
+    run a blocking function in the thread pool of the event loop
+    :return: awaitable with the result of the function
+    """
+    return asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+def in_background(function, *args):
+    """
+    run a long blocking function in the background executor
+    :return: awaitable with the result of the function
+    """
+    return asyncio.get_event_loop().run_in_executor(background_executor, function, *args)
+
+
+async def serve(bots):
+    """
+    run bots until SIGINT or SIGTERM is received, toots that are being
+    posted at that moment are finished before shutting down
+    :param bots: list of BotClass instances
+    """
+    loop = asyncio.get_event_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(signum, stop.set)
+        except NotImplementedError:
+            # windows has no signal handlers for event loops
+            pass
+    tasks = [asyncio.ensure_future(bot.run()) for bot in bots]
+    stopping = asyncio.ensure_future(stop.wait())
+    await asyncio.wait(tasks + [stopping], return_when=asyncio.FIRST_COMPLETED)
+    logger.info("shutting down...")
+    for task in tasks + [stopping]:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception):
+            logger.warning(repr(result))
 
 
 class BotClass():
@@ -87,170 +254,754 @@ class BotClass():
     schema_db_path = "schema/db.json"
     schema_image_path = "schema/image.json"
     db = {"images": []}
-
-    def __init__(self, config):
-        logger.debug("loading config...")
-        with open(self.schema_config_path) as data:
-            self.schema_config = json.load(data)
+    # seconds the first toot is delayed to stagger bots in one process
+    delay = 0
+    # mastodon deletes media that isn't attached to a toot after a while
+    upload_ttl = 6 * 60 * 60
+    limits_ttl = 24 * 60 * 60
+    limits_retry_ttl = 10 * 60
+    status_ttl = 30 * 24 * 60 * 60
+    # failed toots are tried again after retry_backoff seconds, doubling
+    # for every attempt
+    retry_backoff = 60
+    retry_max_delay = 60 * 60
+    retry_attempts = 8
+    # images are validated in batches while the db is loaded
+    validate_batch = 1000
+    # settings that are only read on startup, reloading the config
+    # doesn't change them
+    restart_settings = ("name", "domain", "access_token", "client_id", "client_secret",
+                        "db_path", "cache_path", "history_path", "accounts",
+                        "http", "metrics", "respond")
+
+    def __init__(self, config, config_path=None):
+        """
+        :param config: dictionary following schema/config.json
+        :param config_path: string with the path of the config, it is
+                            reloaded when the file changes while running
+        """
+        self.config_path = config_path
+        # held while the db is loaded or images are chosen and marked
+        self.load_lock = threading.RLock()
+        # set when the bot shuts down to end background work early
+        self.stopping = threading.Event()
+        # seconds toots were posted after their scheduled slots
+        self.drift = {"count": 0, "total": 0, "max": 0}
+        # ids of the images by their normalized sources
+        self.sources = SourceIndex(Catalog(), normalize_source)
+        # ids of the images by tags, authors, nsfw, source type and posted
+        self.index = ImageIndex()
+        self.phashes = media.PerceptualIndex()
 
         logger.debug("validating config...")
-        validate(config, self.schema_config)
+        get_validator(self.schema_config_path).validate(config)
         logger.debug("config is valid!")
         # apply dictionary as properties of self.settings
-        self.settings = json.loads(
-            json.dumps(config), object_hook=lambda d: namedtuple('X', d.keys())(*d.values()))
+        self.settings = namespace(config)
+        # name of the bot in metrics, the db tells unnamed bots apart
+        self.label = getattr(self.settings, "name", None) or \
+            os.path.splitext(os.path.basename(self.settings.db_path))[0]
 
         logger.debug(self.settings)
 
+        try:
+            http = self.settings.http
+        except AttributeError:
+            logger.debug("using default http settings")
+            http = None
+        http_client.configure(http)
+        try:
+            metrics.configure(self.settings.metrics)
+        except AttributeError:
+            metrics.configure(None)
+        self.selector = Selector(self.image_weight,
+                                 seed=getattr(self.selection_settings(), "seed", None))
+        self.db = {"images": []}
+        self.configure_selection()
+
+        self.storage = open_storage(self.settings.db_path)
+        try:
+            cache_path = self.settings.cache_path
+        except AttributeError:
+            cache_path = os.path.splitext(self.settings.db_path)[0] + ".cache.sqlite"
+        self.cache = Cache(cache_path)
+        try:
+            history_path = self.settings.history_path
+        except AttributeError:
+            history_path = os.path.splitext(self.settings.db_path)[0] + ".history.jsonl"
+        self.history = History(history_path)
+        self.outbox = Outbox(cache_path)
+        # ids of outbox toots this process is working on
+        self.active = set()
         self.load_images()
-        self.login()
+        for toot in self.outbox.pending():
+            self.selector.hold(toot["index"])
 
-    def login(self):
+    def selection_settings(self):
+        try:
+            return self.settings.selection
+        except AttributeError:
+            return None
+
+    def configure_selection(self):
+        """
+        apply the selection settings to the selector, called again when
+        the config is reloaded
+        """
+        selection = self.selection_settings()
+        # only images matching the filter query are posted, it's parsed
+        # first so an invalid query doesn't change anything
+        filter = getattr(selection, "filter", None)
+        query = parse_query(filter) if filter else None
+        self.selector.no_repeat = getattr(selection, "no_repeat", 0)
+        while len(self.selector.recent) > self.selector.no_repeat:
+            self.selector.recent.popleft()
+        self.filter = query
+        self.selector.allowed = None if query is None else self.index.query(query)
+        self.selector.build(self.db["images"])
+
+    # clients are created the first time they are used, so a single
+    # --post doesn't log in to every account
+    @cached_property
+    def mastodon_api(self):
         logger.info("login into mastodon bot...")
-        self.mastodon_api = Mastodon(client_id=self.settings.client_id,
-                                     client_secret=self.settings.client_secret,
-                                     access_token=self.settings.access_token,
-                                     api_base_url=self.settings.domain)
+        return shared_client(
+            ("mastodon", self.settings.domain, self.settings.access_token),
+            lambda: mastodon_login(self.settings))
+
+    @cached_property
+    def tweet_api(self):
         try:
-            logger.info("login into twitter account...")
-            auth = tweepy.OAuthHandler(self.settings.accounts.twitter.consumer_key,
-                                       self.settings.accounts.twitter.consumer_secret)
-            auth.set_access_token(self.settings.accounts.twitter.access_token,
-                                  self.settings.accounts.twitter.access_token_secret)
-            self.tweet_api = tweepy.API(auth)
+            twitter = self.settings.accounts.twitter
         except AttributeError:
             logger.debug("twitter credentials not definied")
-            self.tweet_api = False
+            return False
+        logger.info("login into twitter account...")
+        return shared_client(
+            ("twitter", twitter.consumer_key, twitter.consumer_secret,
+             twitter.access_token, twitter.access_token_secret),
+            lambda: twitter_login(twitter))
+
+    @cached_property
+    def danbooru_api(self):
         try:
-            logger.info("login into danbooru account...")
-            self.danbooru_api = Danbooru('danbooru',
-                                         username=self.settings.accounts.danbooru.username,
-                                         api_key=self.settings.accounts.danbooru.token)
+            danbooru = self.settings.accounts.danbooru
         except AttributeError:
             logger.debug("danbooru credentials not definied")
-            self.danbooru_api = False
+            return False
+        logger.info("login into danbooru account...")
+        return shared_client(
+            ("danbooru", danbooru.username, danbooru.token),
+            lambda: danbooru_login(danbooru))
+
+    @cached_property
+    def pixiv_api(self):
         try:
-            logger.info("login into pixiv account...")
-            self.pixiv_api = AppPixivAPI()
-            self.pixiv_api.login(self.settings.accounts.pixiv.username,
-                                 self.settings.accounts.pixiv.password)
+            pixiv = self.settings.accounts.pixiv
         except AttributeError:
             logger.debug("pixiv credentials not definied")
-            # self.pixiv_api = AppPixivAPI()
-            self.pixiv_api = False
+            return False
+        logger.info("login into pixiv account...")
+        return shared_client(
+            ("pixiv", pixiv.username, pixiv.password),
+            lambda: pixiv_login(pixiv, self.cache))
 
     def post_toot(self):
+        with metrics.toot_time.time(bot=self.label):
+            self.publish_toot(self.prepare_toot())
+
+    def prepare_toot(self):
+        """
+        chooses an image and does everything a toot needs before it can be
+        posted: the search for toots to boost and the media upload
+        :return: dictionary with everything publish_toot needs
+        """
         logger.info("creating new toot...")
-        self.load_images()
-        image = {}
-        while not image:
+        with self.load_lock:
+            self.load_images()
             logger.debug("choosing random image...")
-            image = random.choice(self.db['images'])
-            logger.debug(image)
-            source = image['source']
-            paths = image['image_paths']
-            try:
-                source = image['posted']
-                posted = True
-                # to reduce boosting repeat process in 70% of cases
-                # if the image has already been posted
-                if random.randint(0, 100) < 70:
-                    image = {}
-            except KeyError:
-                posted = False
+            index = self.selector.choose()
+            if index is None:
+                raise ValueError("no image available to post")
+            image = self.db['images'][index]
+            self.selector.hold(index)
+        logger.debug(image)
+        source = image['source']
+        # already posted images boost the posted toot
+        try:
+            source = image['posted']
+        except KeyError:
+            pass
+        toot = {"index": index, "source": source, "state": "selected",
+                "boost": self.is_boost(image), "created": time.time()}
         # check if already posted or a mastodon link to boost original toot
-        if paths[0] == "mastodon.png" or posted or re_mastodon.search(source):
-            search = self.mastodon_api.search(source, resolve=True)
-            logger.debug(search)
-            status_id = search['statuses'][0]['id']
-            logger.debug("toot id: " + str(status_id))
-            logger.debug("boosting toot...")
-            toot = self.mastodon_api.status_reblog(status_id)
+        if not toot["boost"]:
+            toot["status"] = self.status_text(image)
+            toot["paths"] = image['image_paths']
+        # retry_toots only takes over once the toot failed or got stuck
+        toot["id"] = self.outbox.add(toot, delay=self.upload_ttl)
+        self.advance_toot(toot, until="uploaded")
+        return toot
+
+    def status_text(self, image):
+        """
+        :param image: dictionary following schema/image.json
+        :return: string with the text of a toot posting the image
+        """
+        name = image['author']['name']
+        handle = image['author']['handle']
+        status = "Created by: {}({})\nSource: {}".format(
+            name, handle, image['source'])
+        try:
+            additional = image['additional']
+            for link in additional:
+                status += "\n" + link
+        except KeyError:
+            pass
+        try:
+            description = image['description']
+            status += "\n\n" + description[:400]
+        except KeyError:
+            pass
+        return status
+
+    def publish_toot(self, toot):
+        """
+        posts or boosts a toot prepared by prepare_toot and saves it to the db
+        :param toot: dictionary returned by prepare_toot
+        """
+        self.advance_toot(toot)
+
+    def advance_toot(self, toot, until="recorded"):
+        """
+        runs the remaining steps of a toot from the outbox, every finished
+        step is saved, failed toots are tried again later by retry_toots
+        :param toot: dictionary from the outbox
+        :param until: state the toot should reach
+        """
+        steps = {"selected": self.upload_toot,
+                 "uploaded": self.post_status,
+                 "posted": self.record_toot}
+        # mastodon deletes media that isn't attached to a toot after a while
+        if toot["state"] == "uploaded" and not toot["boost"] and \
+                toot["uploaded"] + self.upload_ttl < time.time():
+            toot["state"] = "selected"
+        self.active.add(toot["id"])
+        try:
+            while toot["state"] != until:
+                steps[toot["state"]](toot)
+                toot["state"] = outbox.states[outbox.states.index(toot["state"]) + 1]
+                logger.debug("toot {} {}".format(toot["id"], toot["state"]))
+                if toot["state"] == "recorded":
+                    self.outbox.remove(toot["id"])
+                else:
+                    self.outbox.update(toot["id"], toot)
+        except Exception as e:
+            self.active.discard(toot["id"])
+            attempts = self.outbox.attempts(toot["id"]) + 1
+            if attempts >= self.retry_attempts:
+                logger.warning("giving up on toot of image {} after {} attempts".format(
+                    toot["index"], attempts))
+                self.outbox.remove(toot["id"])
+                self.selector.release(toot["index"])
+            else:
+                delay = min(self.retry_backoff * 2 ** (attempts - 1), self.retry_max_delay)
+                self.outbox.failed(toot["id"], repr(e), delay)
+                logger.warning("toot of image {} failed, trying again in {}s".format(
+                    toot["index"], delay))
+            raise
+        if until == "recorded":
+            self.active.discard(toot["id"])
+
+    def upload_toot(self, toot):
+        if toot["boost"]:
+            toot["status_id"] = self.find_status(toot["source"])
         else:
-            name = image['author']['name']
-            handle = image['author']['handle']
-            status = "Created by: {}({})\nSource: {}".format(
-                name, handle, source)
-            try:
-                additional = image['additional']
-                for link in additional:
-                    status += "\n" + link
-            except KeyError:
-                pass
+            toot["media_ids"] = self.upload_media(toot["paths"])
+            toot["uploaded"] = time.time()
+
+    def post_status(self, toot):
+        from mastodon import MastodonNotFoundError
+        if toot["boost"]:
+            logger.debug("boosting toot...")
+            status_id = toot["status_id"]
             try:
-                description = image['description']
-                status += "\n\n" + description[:400]
-            except KeyError:
-                pass
+                status = self.mastodon_api.status_reblog(status_id)
+            except MastodonNotFoundError:
+                # the cached id is outdated, search the toot again
+                self.cache.delete("status:" + toot["source"])
+                status_id = self.find_status(toot["source"])
+                status = self.mastodon_api.status_reblog(status_id)
+        else:
+            image = self.db['images'][toot["index"]]
             try:
                 nsfw = image['nsfw']
             except KeyError:
                 nsfw = False
 
-            media_ids = []
-            for path in paths:
-                logger.debug("'{}' uploading...".format(path))
-                media = self.mastodon_api.media_post(media_file=path)
-                media_ids.append(media['id'])
-                logger.debug(media)
-
             logger.debug("posting toot...")
             try:
                 cw = image['cw']
-                toot = self.mastodon_api.status_post(status,
-                                                     media_ids=media_ids,
-                                                     sensitive=nsfw,
-                                                     visibility='public',
-                                                     spoiler_text=cw)
+                status = self.mastodon_api.status_post(toot["status"],
+                                                       media_ids=toot["media_ids"],
+                                                       sensitive=nsfw,
+                                                       visibility='public',
+                                                       spoiler_text=cw)
             except KeyError:
-                toot = self.mastodon_api.status_post(status,
-                                                     media_ids=media_ids,
-                                                     sensitive=nsfw,
-                                                     visibility='public')
-        logger.debug(toot)
-        image['posted'] = toot['url']
-        logger.info(toot['url'])
-        with open(self.settings.db_path, 'w') as output:
-            json.dump(self.db, output)  # save to database
+                status = self.mastodon_api.status_post(toot["status"],
+                                                       media_ids=toot["media_ids"],
+                                                       sensitive=nsfw,
+                                                       visibility='public')
+            # attached media can't be used for another toot
+            for path in toot["paths"]:
+                self.cache.delete("media:" + media.file_digest(path))
+            status_id = status['id']
+        logger.debug(status)
+        toot["posted"] = {"id": status_id, "url": status['url']}
+
+    def record_toot(self, toot):
+        # boosting this toot again later won't need a search
+        self.cache.set("status:" + toot["posted"]["url"], toot["posted"]["id"],
+                       ttl=self.status_ttl)
+        with self.load_lock:
+            self.load_images()
+            image = self.db['images'][toot["index"]]
+            self.index.remove(toot["index"], image)
+            image['posted'] = toot["posted"]["url"]
+            self.db['images'][toot["index"]] = image
+            self.index.add(toot["index"], image)
+            if self.filter is not None:
+                if self.index.matches(self.filter, image):
+                    self.selector.allowed.add(toot["index"])
+                else:
+                    self.selector.allowed.discard(toot["index"])
+            logger.info(toot["posted"]["url"])
+            self.storage.save(toot["index"], image)  # save to database
+            self.history.append(toot["index"], toot["posted"]["url"], toot["boost"],
+                                time.time() - toot.get("created", time.time()))
+            self.refresh_history()
+            self.selector.mark(toot["index"])
         logger.debug("toot url saved to db")
-        # logger.debug(self.db)
 
-    def scheduled_toots(self):
+    def refresh_history(self):
+        """
+        weigh images again that were posted, by this or other processes,
+        since the history was last read
+        """
+        with self.load_lock:
+            for index in self.history.refresh():
+                if index < len(self.selector.tree):
+                    self.selector.update(index)
+
+    async def retry_toots(self):
+        """
+        continues failed toots and toots interrupted by a crash once
+        their backoff passed, independent of the scheduled slots
+        """
+        while True:
+            wait = 60
+            try:
+                # keep other processes from taking over toots waiting for their slot
+                self.outbox.renew(list(self.active))
+                # toots of crashed processes are continued once their lease ran out
+                self.outbox.resume()
+                for toot in self.outbox.pending(before=time.time()):
+                    if toot["id"] in self.active or not self.outbox.claim(toot["id"]):
+                        continue
+                    logger.info("retrying toot of image {}".format(toot["index"]))
+                    try:
+                        await asyncio.shield(in_thread(self.advance_toot, toot))
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception as e:
+                        logger.warning(repr(e))
+                next_try = self.outbox.next_try()
+                if next_try is not None:
+                    wait = next_try - time.time()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # a locked or broken outbox must not stop the bot, try again later
+                logger.warning(repr(e))
+                logger.warning(error_info(e))
+            await asyncio.sleep(min(max(wait, 1), 60))
+
+    def is_boost(self, image):
+        """
+        :param image: dictionary following schema/image.json
+        :return: True if the image is posted by boosting a toot
+        """
+        return image['image_paths'][0] == "mastodon.png" or \
+            "posted" in image or bool(re_mastodon.search(image['source']))
+
+    def find_status(self, url):
+        """
+        :param url: string with the url to a toot
+        :return: id of the toot on our instance
+        """
+        status_id = self.cache.get("status:" + url)
+        if status_id is not None:
+            logger.debug("cached toot id: " + str(status_id))
+            return status_id
+        search = self.mastodon_api.search(url, resolve=True)
+        logger.debug(search)
+        status_id = search['statuses'][0]['id']
+        logger.debug("toot id: " + str(status_id))
+        self.cache.set("status:" + url, status_id, ttl=self.status_ttl)
+        return status_id
+
+    def warm_status_cache(self):
+        """
+        resolve the toot ids of all images that get boosted ahead of time
+        """
+        for image in self.db["images"]:
+            if self.stopping.is_set():
+                return
+            if not self.is_boost(image):
+                continue
+            url = image.get("posted", image["source"])
+            if self.cache.get("status:" + url) is not None:
+                continue
+            try:
+                self.find_status(url)
+            except Exception as e:
+                logger.debug("couldn't resolve {}: {}".format(url, repr(e)))
+        logger.debug("toot id cache warmed up")
+
+    def image_weight(self, image, index=None):
+        """
+        :param image: dictionary following schema/image.json
+        :param index: id of the image, used to look up how often it was posted
+        :return: number, images are picked proportional to their weight
+        """
+        try:
+            weights = self.settings.selection
+        except AttributeError:
+            weights = None
+        weight = 1.0
+        # already posted images get boosted less often
+        if "posted" in image:
+            weight *= getattr(weights, "posted", 0.3)
+        if image.get("nsfw"):
+            weight *= getattr(weights, "nsfw", 1.0)
+        weight *= getattr(getattr(weights, "sources", None),
+                          source_type(image["source"]), 1.0)
+        # every further toot of an image makes it less likely again
+        count, last = self.history.counts.get(index, (0, None))
+        if count > 1:
+            weight *= getattr(weights, "repeat", 0.7) ** (count - 1)
+        return weight
+
+    def upload_media(self, paths, cached=True):
+        """
+        uploads all files at the same time, files that were already
+        uploaded for a toot that failed aren't uploaded again
+        :param paths: list of strings with paths to the files
+        :param cached: False to always upload, for media that is attached
+                       outside of the scheduled toots
+        :return: list of media ids in the same order as paths
+        """
+        with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+            return list(executor.map(self.upload_file, paths, [cached] * len(paths)))
+
+    def upload_file(self, path, cached=True):
+        key = "media:" + media.file_digest(path)
+        media_id = self.cache.get(key) if cached else None
+        if media_id is not None:
+            logger.debug("'{}' already uploaded".format(path))
+            return media_id
+        logger.debug("'{}' uploading...".format(path))
+        with metrics.upload_time.time(bot=self.label):
+            attachment = self.mastodon_api.media_post(media_file=path)
+        logger.debug(attachment)
+        if cached:
+            self.cache.set(key, attachment['id'], ttl=self.upload_ttl)
+        return attachment['id']
+
+    async def run(self):
+        """
+        runs scheduled toots and background work until cancelled
+        """
+        tasks = [asyncio.ensure_future(self.scheduled_toots()),
+                 asyncio.ensure_future(self.retry_toots()),
+                 in_background(self.warm_status_cache)]
+        if getattr(self.settings, "respond", False):
+            tasks.append(asyncio.ensure_future(self.answer_mentions(Responder(self))))
+        watcher = self.watch_files()
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            self.stopping.set()
+            watcher.stop()
+            for task in tasks:
+                task.cancel()
+            # let the tasks close their streams
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def answer_mentions(self, responder):
+        """
+        keeps the stream of mentions open, a failed or closed stream is
+        opened again with a growing delay instead of stopping the bot
+        :param responder: Responder answering the mentions
+        """
+        stream = None
+        delay = self.retry_backoff
+        try:
+            while True:
+                if stream is not None and stream.is_alive():
+                    await asyncio.sleep(60)
+                    continue
+                if stream is not None:
+                    logger.warning("stream of mentions closed, reconnecting...")
+                try:
+                    stream = await in_thread(responder.listen)
+                    delay = self.retry_backoff
+                except Exception as e:
+                    stream = None
+                    logger.warning("couldn't listen for mentions, trying again in {}s: {}".format(
+                        delay, repr(e)))
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.retry_max_delay)
+        finally:
+            if stream is not None:
+                stream.close()
+            responder.close()
+
+    def watch_files(self):
+        """
+        reload the config and the db when they change while running
+        :return: the started Watcher
+        """
+        watcher = Watcher()
+        if self.config_path is not None:
+            watcher.watch(self.config_path, self.reload_config)
+        db_path = self.settings.db_path
+        for path in [db_path] if db_path.endswith(".json") else sqlite_files(db_path):
+            watcher.watch(path, lambda path: self.load_images())
+        # toots posted by other processes make their images less likely
+        watcher.watch(self.history.path, lambda path: self.refresh_history())
+        watcher.start()
+        return watcher
+
+    def reload_config(self, path):
+        """
+        apply a changed config, settings that need new clients or files
+        keep their old values until the bot is restarted
+        :param path: string with the path to the config
+        """
+        try:
+            with open(path) as data:
+                config = json.load(data)
+            get_validator(self.schema_config_path).validate(config)
+            settings = namespace(config)
+            # the schema can't check the filter query
+            filter = getattr(getattr(settings, "selection", None), "filter", None)
+            if filter:
+                parse_query(filter)
+        except Exception as e:
+            logger.warning("keeping the old config, {} is invalid: {}".format(path, repr(e)))
+            return
+        for key in self.restart_settings:
+            old = getattr(self.settings, key, None)
+            if getattr(settings, key, None) != old:
+                logger.warning("restart the bot to change " + key)
+            if old is None:
+                if hasattr(settings, key):
+                    delattr(settings, key)
+            else:
+                setattr(settings, key, old)
+        if getattr(getattr(settings, "selection", None), "seed", None) != \
+                getattr(self.selection_settings(), "seed", None):
+            logger.warning("restart the bot to change selection.seed")
+        with self.load_lock:
+            self.settings = settings
+            self.configure_selection()
+        logger.info("reloaded config " + path)
+
+    def schedule(self):
+        """
+        :return: tuple with the seconds between toots and the seconds a
+                 toot is prepared ahead of its slot
+        """
+        offset = self.settings.offset_min * 60
+        try:
+            lead = min(self.settings.lead_sec, offset)
+        except AttributeError:
+            lead = min(60, offset)
+        return offset, lead
+
+    async def scheduled_toots(self):
+        """
+        prepares every toot lead_sec seconds ahead of its slot, so only
+        posting or boosting happens at the scheduled time
+        """
+        offset, lead = self.schedule()
         logger.debug("posting toots every: {}min".format(
             self.settings.offset_min))
-        schedule.every(self.settings.offset_min).minutes.do(self.post_toot)
+        # the interval is read again while waiting, a reloaded config
+        # moves the next slot right away
+        last = time.time() + self.delay
         while True:
+            while True:
+                offset, lead = self.schedule()
+                slot = last + offset
+                if slot - lead <= time.time():
+                    # a shorter interval can move the slot into the past
+                    slot = max(slot, time.time())
+                    break
+                await asyncio.sleep(min(slot - lead - time.time(), 5))
             try:
-                schedule.run_pending()
+                start = time.perf_counter()
+                toot = await in_thread(self.prepare_toot)
+                prepared = time.perf_counter() - start
+                await sleep_until(slot)
+                start = time.perf_counter()
+                # let a started toot finish even when shutting down
+                await asyncio.shield(in_thread(self.publish_toot, toot))
+                # waiting for the slot doesn't count
+                metrics.toot_time.observe(prepared + time.perf_counter() - start,
+                                          bot=self.label)
+                self.record_drift(time.time() - slot)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
+                metrics.toot_errors.inc(bot=self.label,
+                                        error=type(e).__name__)
                 logger.warning(repr(e))
                 logger.warning(error_info(e))
-            time.sleep(1)
+            last = slot
+            # skip slots that were missed while preparing or posting, the
+            # config might have been reloaded in the meantime
+            offset, lead = self.schedule()
+            while last + offset - lead < time.time():
+                logger.warning("skipping missed slot")
+                last += offset
+
+    def record_drift(self, drift):
+        """
+        :param drift: seconds between the scheduled slot and the posted toot
+        """
+        self.drift["count"] += 1
+        self.drift["total"] += drift
+        self.drift["max"] = max(self.drift["max"], drift)
+        metrics.drift.observe(drift, bot=self.label)
+        logger.info("toot posted {:.2f}s after its slot (avg {:.2f}s, max {:.2f}s)".format(
+            drift, self.drift["total"] / self.drift["count"], self.drift["max"]))
 
     def load_images(self):
-        logger.debug("loading images from: " + self.settings.db_path)
-        with open(self.schema_db_path) as data:
-            self.schema_db = json.load(data)
-
-        if os.path.isfile(self.settings.db_path):
-            with open(self.settings.db_path) as data:
-                self.db = json.load(data)
-
-        # change relative paths to a absolute paths
-        schema_path = 'file:///{0}/'.format(
-            os.path.dirname(os.path.abspath(self.schema_db_path)).replace("\\", '/'))
-        resolver = RefResolver(schema_path, self.schema_db)
-        logger.debug("validating db...")
-        validate(self.db, self.schema_db, resolver=resolver)
+        """
+        loads the db, after the first load only images that were added or
+        changed since then, e.g. by --add running next to the bot
+        """
+        with self.load_lock:
+            if not self.storage.changed():
+                logger.debug("db unchanged since last load")
+                return
+            logger.debug("loading images from: " + self.settings.db_path)
+            with metrics.db_load.time(bot=self.label):
+                changes = self.storage.changes()
+                if changes is None or not self.apply_changes(changes):
+                    self.storage.discard()
+                    self._load_images()
+
+    def _load_images(self):
+        """
+        builds everything from a stream of the stored images, so the
+        dictionaries of all images are never in memory at the same time
+        """
+        catalog = Catalog(self.storage.get)
+        phashes = media.PerceptualIndex()
+        index = ImageIndex()
+        validate_time = 0
+
+        # the storage only loads everything again if it can't tell what
+        # changed, so all images are validated
+        batch = []
+        for position, image in enumerate(self.storage.stream()):
+            batch.append((position, image))
+            if len(batch) >= self.validate_batch:
+                start = time.perf_counter()
+                self.validate_images(batch)
+                validate_time += time.perf_counter() - start
+                batch = []
+            catalog.append(image)
+            for phash in image.get("phashes", []):
+                phashes.add(phash, position)
+            index.add(position, image)
+        start = time.perf_counter()
+        self.validate_images(batch)
+        validate_time += time.perf_counter() - start
+        metrics.db_validate.observe(validate_time, bot=self.label)
         logger.debug("db is valid!")
-        # logger.debug("validating db...")
-        # validate(self.db, self.schema_db)
-        # logger.debug("db is valid!")
+        # map normalized sources to image ids for fast duplicate checks
+        sources = SourceIndex(catalog, normalize_source)
+        sources.build()
+
+        self.db = {"images": catalog}
+        self.sources = sources
+        self.phashes = phashes
+        self.index = index
+        if self.filter is not None:
+            self.selector.allowed = self.index.query(self.filter)
+        self.selector.build(self.db["images"])
+
+    def validate_images(self, items):
+        """
+        :param items: list of (id, image) tuples
+        :raises ValidationError: if any image doesn't follow schema/image.json,
+                                 the ids of all invalid images are logged
+        """
+        validator = get_validator(self.schema_db_path)
+        errors = list(validator.iter_errors({"images": [image for index, image in items]}))
+        if errors:
+            ids = sorted({items[error.absolute_path[1]][0] for error in errors
+                          if len(error.absolute_path) > 1})
+            logger.error("invalid images in {}: {}".format(
+                self.settings.db_path, ", ".join(str(index) for index in ids)))
+            raise best_match(errors)
+
+    def apply_changes(self, changes):
+        """
+        :param changes: list of (id, image) tuples from storage.changes()
+        :return: False if the changes can't be applied and a full load is needed
+        """
+        images = self.db["images"]
+        # new ids have to continue the loaded ones without gaps
+        new = [index for index, image in changes if index >= len(images)]
+        if new != list(range(len(images), len(images) + len(new))):
+            return False
+        logger.debug("validating {} changed images...".format(len(changes)))
+        # the storage only counts the changes as loaded once they are valid,
+        # so invalid images are found again by the next load
+        with metrics.db_validate.time(bot=self.label):
+            self.validate_images(changes)
+        self.storage.confirm()
+
+        for index, image in changes:
+            if index < len(images):
+                self.sources.remove(index)
+                self.index.remove(index, images.summary(index))
+                images[index] = image
+            else:
+                images.append(image)
+            self.sources.add(index)
+            # hashes of the old version stay, they only cause an extra check
+            for phash in image.get("phashes", []):
+                self.phashes.add(phash, index)
+            self.index.add(index, image)
+            if self.filter is not None:
+                if self.index.matches(self.filter, image):
+                    self.selector.allowed.add(index)
+                else:
+                    self.selector.allowed.discard(index)
+            if index < len(self.selector.tree):
+                self.selector.update(index)
+            else:
+                self.selector.append(image)
+        logger.debug("applied {} changed images".format(len(changes)))
+        return True
 
     def add_images(self):
-        with open(self.schema_image_path) as data:
-            self.schema_image = json.load(data)
-
         while True:
             logger.debug("adding Image to db")
             # logger.debug(self.db)
@@ -262,45 +1013,244 @@ class BotClass():
                 if self.image_exists(source):
                     print("already added!")
                     continue  # jump into next loop
-                # if url is part of these automatically retrieve image and
-                # additional info
-                if re_mastodon.search(source):
-                    image = {
-                        "source": source,
-                        "image_paths": ["mastodon.png"],
-                        "author": {
-                            "handle": "",
-                            "name": ""
-                        },
-                        "description": "",
-                        "nsfw": False
-                    }
-                elif re_twitter.search(source) and self.tweet_api:
-                    image = self.twitter_info(source)
-                elif re_danbooru.search(source):
-                    image = self.danbooru_info(source)
-                elif re_pixiv.search(source) and self.pixiv_api:
-                    # currently pixiv downloading only works while logged in to
-                    # pixiv
-                    image = self.pixiv_info(source)
-                else:
+                image = self.resolve_source(source)
+                if not image:
                     # enter info manually
                     image = self.manual_info(source)
                 if self.image_exists(image["source"]):
                     print("already added!")
                     continue  # jump into next loop
+                # hash the downloaded files, duplicates are never encoded
+                self.hash_image(image)
+                similar = self.near_duplicate(image)
+                if similar is not None:
+                    print("similar to already added image: " +
+                          self.db["images"][similar]["source"])
+                    continue  # jump into next loop
+                self.prepare_media(image)
 
                 logger.debug("validating entered info...")
-                validate(image, self.schema_image)
+                get_validator(self.schema_image_path).validate(image)
                 logger.debug("info is valid")
 
-                self.db["images"].append(image)
-                with open(self.settings.db_path, 'w') as output:
-                    json.dump(self.db, output)  # save to database
+                self.add_image(image)
                 logger.info("{} images in db".format(len(self.db["images"])))
             else:
                 break
 
+    def import_images(self, sources, workers=8, per_host=2, batch_size=50):
+        """
+        add a list of sources without any prompts, sources are resolved
+        and downloaded concurrently
+        :param sources: iterable of strings with urls to the sources
+        :param workers: number of sources resolved at the same time
+        :param per_host: number of sources resolved at the same time per host
+        :param batch_size: number of images saved to the db at once
+        :return: tuple with the number of added, skipped and failed sources
+        """
+        self.load_images()
+        pending = []
+        keys = set()
+        skipped = 0
+        for source in sources:
+            source = source.strip()
+            if not source:
+                continue
+            key = normalize_source(source)
+            if key in keys or key in self.sources:
+                skipped += 1
+                continue
+            keys.add(key)
+            pending.append(source)
+        logger.info("importing {} sources, skipping {} duplicates".format(
+            len(pending), skipped))
+
+        host_locks = {}
+        for source in pending:
+            host = urlsplit(source).netloc
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(per_host)
+
+        def resolve(source):
+            with host_locks[urlsplit(source).netloc]:
+                image = self.resolve_source(source)
+            if not image:
+                raise ValueError("no way to automatically resolve this source")
+            self.hash_image(image)
+            get_validator(self.schema_image_path).validate(image)
+            return image
+
+        added = 0
+        failed = []
+        batch = []
+        resolved = set()
+        phashes = media.PerceptualIndex()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(resolve, source): source
+                       for source in pending}
+            for future in as_completed(futures):
+                source = futures[future]
+                try:
+                    image = future.result()
+                except Exception as e:
+                    logger.warning("failed to import {}: {}".format(
+                        source, repr(e)))
+                    failed.append(source)
+                    continue
+                # the resolved source can differ from the entered one
+                key = normalize_source(image["source"])
+                if key in self.sources or key in resolved:
+                    skipped += 1
+                    continue
+                if self.near_duplicate(image) is not None or \
+                        self.near_duplicate(image, phashes) is not None:
+                    logger.info("skipping {}, similar image already added".format(
+                        source))
+                    skipped += 1
+                    continue
+                resolved.add(key)
+                for phash in image.get("phashes", []):
+                    phashes.add(phash, len(resolved))
+                batch.append(image)
+                if len(batch) >= batch_size:
+                    self.prepare_media(*batch)
+                    added += len(self.add_image(*batch))
+                    batch = []
+                    logger.info("{} images in db".format(
+                        len(self.db["images"])))
+        if batch:
+            self.prepare_media(*batch)
+            added += len(self.add_image(*batch))
+
+        logger.info("imported {} images, skipped {}, failed {}".format(
+            added, skipped, len(failed)))
+        for source in failed:
+            logger.info("failed: " + source)
+        return added, skipped, len(failed)
+
+    def resolve_source(self, source):
+        """
+        automatically retrieve image and additional info
+        :param source: string with the url to the source
+        :return: dictionary following schema/image.json or None if the
+                 source can't be resolved automatically
+        """
+        resolver = find_resolver(self, source)
+        if resolver is None:
+            return None
+        logger.debug("resolving with " + resolver.name)
+        try:
+            return resolver.resolve(self, source)
+        except Exception:
+            metrics.resolve_errors.inc(resolver=resolver.name)
+            raise
+
+    def add_image(self, *images):
+        """
+        :param images: dictionaries following schema/image.json
+        :return: list with the ids of the new images
+        """
+        # the storage assigns the ids, so other processes adding images at
+        # the same time don't overwrite each other
+        ids = self.storage.append(list(images))  # save to database
+        self.load_images()
+        return ids
+
+    def media_limits(self):
+        """
+        :return: dictionary with the upload limits of the instance, values
+                 from the config take precedence
+        """
+        limits = self.cache.get("instance:media_limits")
+        if limits is None:
+            limits = dict(media.default_limits)
+            try:
+                instance = self.mastodon_api.instance()
+                attachments = instance['configuration']['media_attachments']
+                limits["image_size"] = attachments['image_size_limit']
+                limits["video_size"] = attachments['video_size_limit']
+                limits["image_pixels"] = attachments['image_matrix_limit']
+                ttl = self.limits_ttl
+            except Exception as e:
+                logger.debug("instance has no media limits: " + repr(e))
+                # ask again soon, the instance might just be down
+                ttl = self.limits_retry_ttl
+            self.cache.set("instance:media_limits", limits, ttl=ttl)
+        for key in limits:
+            try:
+                limits[key] = getattr(self.settings.media_limits, key)
+            except AttributeError:
+                pass
+        return limits
+
+    def prepare_media(self, *images):
+        """
+        fits all files of the images into the upload limits of the
+        instance, encoding runs in a process pool so posting never waits
+        :param images: dictionaries following schema/image.json, their
+                       image_paths are replaced with the prepared files
+        """
+        limits = self.media_limits()
+        signature = "{image_size}:{video_size}:{image_pixels}".format(**limits)
+        jobs = []
+        for image in images:
+            for i, path in enumerate(image["image_paths"]):
+                if path == "mastodon.png" or not os.path.isfile(path):
+                    continue
+                key = "prepared:{}:{}".format(media.file_digest(path), signature)
+                prepared = self.cache.get(key)
+                if prepared and os.path.isfile(prepared):
+                    image["image_paths"][i] = prepared
+                else:
+                    jobs.append((image, i, path, key))
+        if not jobs:
+            return
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(media.prepare_file, path, limits)
+                       for image, i, path, key in jobs]
+            for (image, i, path, key), future in zip(jobs, futures):
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    logger.warning("couldn't prepare {}: {}".format(path, repr(e)))
+                    continue
+                if prepared != path:
+                    logger.info("{} prepared as {}".format(path, prepared))
+                image["image_paths"][i] = prepared
+                self.cache.set(key, prepared)
+
+    def hash_image(self, image):
+        """
+        add perceptual hashes of all downloaded images to the image info
+        :param image: dictionary following schema/image.json
+        """
+        phashes = []
+        for path in image["image_paths"]:
+            if os.path.isfile(path):
+                phash = media.perceptual_hash(path)
+                if phash:
+                    phashes.append(phash)
+        if phashes:
+            image["phashes"] = phashes
+
+    def near_duplicate(self, image, phashes=None):
+        """
+        :param image: dictionary following schema/image.json
+        :param phashes: perceptual index to search, defaults to the whole db
+        :return: id of a similar image or None
+        """
+        try:
+            distance = self.settings.phash_distance
+        except AttributeError:
+            distance = 4
+        if phashes is None:
+            phashes = self.phashes
+        for phash in image.get("phashes", []):
+            index = phashes.find(phash, distance)
+            if index is not None:
+                return index
+        return None
+
     def manual_info(self, url):
         paths = []
         source = url.strip()
@@ -352,181 +1302,45 @@ class BotClass():
         }
         return image
 
-    def twitter_info(self, url):
-        nsfw = False
-        paths = []
-        handle = ""
-        name = ""
-        description = ""
-        source = url
-
-        id = source.split('/')[-1]
-        tweet = self.tweet_api.get_status(id)
-        logger.debug(tweet.extended_entities['media'])
-
-        for media in tweet.extended_entities['media']:
-            if media['type'] == 'photo':
-                file_url = media['media_url_https']
-
-                path = download_image(file_url)
-                paths.append(path)
-            else:
-                file_url = media['video_info']['variants'][0]['url']
-
-                path = download_image(file_url)
-                paths.append(path)
-
-        handle = "@{}@twitter.com".format(tweet.user.screen_name)
-        name = tweet.user.name
-        # last word is always the shortened link to the media
-        if len(tweet.text.rsplit(' ', 1)):
-            description = tweet.text.rsplit(' ', 1)[0]
-        if tweet.possibly_sensitive:
-            nsfw = True
-
-        image = {
-            "source": source,
-            "image_paths": paths,
-            "author": {
-                "handle": handle.strip(),
-                "name": name.strip()
-            },
-            "description": description.strip(),
-            "nsfw": nsfw
-        }
-        return image
-
-    def danbooru_info(self, url):
-        nsfw = False
-        paths = []
-        handle = ""
-        name = ""
-        description = ""
-        source = url.strip().split("?")[0]
-
-        if self.danbooru_api:
-            id = source.split("/")[-1]
-            post = self.danbooru_api.post_show(id)
-        else:
-            url = source.split("?")[0] + ".json"
-            resp = requests.get(url)
-            post = json.loads(resp.text)
-        logger.debug(post)
-
-        try:
-            file_url = 'http://danbooru.donmai.us' + \
-                post['file_url']
-        except NameError:
-            file_url = post['source']
-        path = download_image(file_url)
-        paths.append(path)
-
-        # get name and handle if possible from pixiv, check if api
-        # shows pawoo handle
-        name = post['tag_string_artist']
-
-        if post['source']:
-            if re_link.search(parse.unquote(post['source'])):
-                source = parse.unquote(post['source'])
-            if re_tweet.search(source):
-                username = re_tweet.search(source).group(1)
-                handle = get_handle(username)
-        if post['pixiv_id']:
-            source = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id=" + \
-                str(post['pixiv_id'])
-            pixiv = self.pixiv_info(source)
-            source = pixiv["source"]
-            if pixiv["author"]["handle"]:
-                handle = pixiv["author"]["handle"]
-            if pixiv["author"]["name"]:
-                name = pixiv["author"]["name"]
-        if post['tag_string_copyright']:
-            description = '#' + \
-                post['tag_string_copyright'].replace(' ', ' #').replace(
-                    "#original", ' ').replace("_(series)", ' ').replace("-", "_")
-        if post['rating'] is not "s":
-            nsfw = True
-
-        image = {
-            "source": source,
-            "image_paths": paths,
-            "author": {
-                "handle": handle.strip(),
-                "name": name.strip()
-            },
-            "description": description.strip(),
-            "nsfw": nsfw
-        }
-        return image
-
-    def pixiv_info(self, url):
-        nsfw = False
-        paths = []
-        handle = ""
-        name = ""
-        description = ""
-        source = url.strip()
-
-        # currently pixiv downloading only works while logged in to
-        # pixiv
-        id = source.split('id=')[1]
-        illust = self.pixiv_api.illust_detail(
-            id, req_auth=True)
-        logger.debug(illust)
-        post = illust.illust
-
-        file_url = post.image_urls[
-            'large'].replace("/c/600x1200_90", '')
-        path = "images/pixiv/" + id + ".jpg"
-        paths.append(path)
-
-        if not os.path.isdir("images/pixiv"):
-            os.makedirs("images/pixiv")
-        self.pixiv_api.download(
-            file_url, path="images/pixiv/", name=id + ".jpg")
-
-        name = post.user['name']
-        handle = str(post.user['id'])
-        user = self.pixiv_api.user_detail(
-            int(handle), req_auth=True)
-        if user.profile['twitter_account']:
-            username = user.profile['twitter_account']
-            handle = get_handle(username)
-        if user.profile['pawoo_url']:
-            # resolve redirected url
-            r = requests.get(user.profile['pawoo_url'])
-            username = r.url.split("@")[1]
-            handle = get_handle(username, domain="pawoo.net")
-
-        try:
-            description = post.title
-            if post.tags:
-                description += "\n\n"
-                for tag in post.tags:
-                    tag = tag['name'].replace(
-                        "/", "_").replace("-", "_")
-                    description += '#' + tag + ' '
-                description = description[:-1]
-        except AttributeError:
-            pass
-
-        image = {
-            "source": source,
-            "image_paths": paths,
-            "author": {
-                "handle": handle.strip(),
-                "name": name.strip()
-            },
-            "description": description.strip(),
-            "nsfw": nsfw
-        }
-        return image
-
     def image_exists(self, source):
-        for image in self.db["images"]:
-            if source == image["source"]:
-                return True
-        return False
+        return normalize_source(source) in self.sources
+
+    def report(self, top=20):
+        """
+        print how often images of every source and the most posted images
+        were tooted
+        :param top: number of images listed
+        """
+        self.load_images()
+        images = self.db["images"]
+
+        def source_of(index):
+            if index >= len(images):
+                return "deleted"
+            return source_type(images.summary(index)["source"])
+        sources, stats = self.history.report(source_of)
+        print("source\timages\tposts\tboosts\tavg latency")
+        for source, total in sorted(sources.items()):
+            toots = total["posts"] + total["boosts"]
+            print("{}\t{}\t{}\t{}\t{:.2f}s".format(
+                source, total["images"], total["posts"], total["boosts"],
+                total["latency"] / toots if toots else 0))
+        print("\nimage\tposts\tboosts\tlast toot\tsource")
+        ranked = sorted(stats.items(), key=lambda item: (
+            -(item[1]["posts"] + item[1]["boosts"]), item[0]))
+        for index, total in ranked[:top]:
+            last = datetime.datetime.utcfromtimestamp(total["last"]).strftime("%Y-%m-%d %H:%M")
+            source = images.summary(index)["source"] if index < len(images) else ""
+            print("{}\t{}\t{}\t{}\t{}".format(
+                index, total["posts"], total["boosts"], last, source))
+
+    def find_images(self, query):
+        """
+        :param query: string with a query, see index.parse_query
+        :return: sorted list of the ids of all matching images
+        """
+        self.load_images()
+        return sorted(self.index.query(query))
 
 
 if __name__ == '__main__':
@@ -539,6 +1353,18 @@ if __name__ == '__main__':
                         action="store_true")
     parser.add_argument("-p", "--post", help="post toot",
                         action="store_true")
+    parser.add_argument("-i", "--import", help="add all sources listed in a file, - reads from stdin",
+                        metavar="FILE", dest="import_file")
+    parser.add_argument("-w", "--workers", help="number of sources imported at the same time",
+                        type=int, default=8)
+    parser.add_argument("-m", "--migrate", help="import images from an old json db",
+                        metavar="FILE")
+    parser.add_argument("-q", "--query", help="list the images matching a query like 'tag:touhou nsfw:false -posted:true'",
+                        metavar="QUERY")
+    parser.add_argument("-r", "--report", help="show how often images were posted",
+                        action="store_true")
+    parser.add_argument("-s", "--supervise", help="run the bots of all configs in a folder",
+                        metavar="DIR")
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
                         action="store_true")
     args = parser.parse_args()
@@ -574,6 +1400,13 @@ if __name__ == '__main__':
     consoleHandler.setFormatter(consoleFormatter)
     logger.addHandler(consoleHandler)
 
+    # run every bot of a folder of configs in this process
+    if args.supervise:
+        bots = load_bots(args.supervise)
+        logger.info("starting scheduled toots for {} bots".format(len(bots)))
+        asyncio.run(serve(bots))
+        sys.exit()
+
     # start bot with desired config
     if args.config:
         config_path = args.config
@@ -582,7 +1415,30 @@ if __name__ == '__main__':
 
     with open(config_path) as data:
         data = json.load(data)
-    bot = BotClass(data)
+    bot = BotClass(data, config_path)
+
+    # import images from an old json db into the configured storage
+    if args.migrate:
+        count = migrate(args.migrate, bot.storage)
+        logger.info("imported {} images from {}".format(count, args.migrate))
+        bot.load_images()
+
+    # print the post history
+    if args.report:
+        bot.report()
+
+    # print the images matching a query
+    if args.query is not None:
+        for index in bot.find_images(args.query):
+            print("{}\t{}".format(index, bot.db["images"].summary(index)["source"]))
+
+    # add all sources from a file without prompting
+    if args.import_file:
+        if args.import_file == "-":
+            bot.import_images(sys.stdin, workers=args.workers)
+        else:
+            with open(args.import_file) as sources:
+                bot.import_images(sources, workers=args.workers)
 
     # start bot in image adding mode
     if args.add:
@@ -593,6 +1449,7 @@ if __name__ == '__main__':
         bot.post_toot()
 
     # start bot in scheduled toot mode
-    if not args.add and not args.post:
+    if not args.add and not args.post and not args.migrate and not args.import_file \
+            and args.query is None and not args.report:
         logger.info("starting scheduled toots")
-        bot.scheduled_toots()
+        asyncio.run(serve([bot]))
@@ -0,0 +1,69 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+logger = logging.getLogger("bot")
+
+
+class Cache():
+    """
+    persistent key value store, values are json and entries can expire
+    """
+
+    def __init__(self, path, table="cache"):
+        """
+        :param path: string with the path to the sqlite file
+        :param table: name of the table, several caches can share one file
+        """
+        self.path = path
+        self.table = table
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL)".format(table))
+
+    def get(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value, expires FROM {} WHERE key = ?".format(self.table),
+                (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return default
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: seconds until the entry expires, None keeps it forever
+        """
+        expires = time.time() + ttl if ttl is not None else None
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO {} (key, value, expires) VALUES (?, ?, ?)".format(
+                    self.table),
+                (key, json.dumps(value), expires))
+
+    def delete(self, key):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM {} WHERE key = ?".format(self.table), (key,))
+
+    def purge(self):
+        """
+        remove all expired entries
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM {} WHERE expires < ?".format(self.table), (time.time(),))
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,288 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+import threading
+
+
+# bits of Catalog.flags
+NSFW = 1
+NSFW_SET = 2
+DESCRIPTION = 4
+AUTHOR = 8
+PHASH = 16
+known = ("source", "image_paths", "author", "description", "nsfw", "cw",
+         "posted", "additional", "phashes")
+
+
+class StringTable():
+    """
+    keeps every distinct string once, strings are referenced by their id
+    and id 0 stands for a missing string
+    """
+
+    def __init__(self):
+        self.strings = [None]
+        self.ids = {None: 0}
+
+    def add(self, string):
+        id = self.ids.get(string)
+        if id is None:
+            id = len(self.strings)
+            self.strings.append(string)
+            self.ids[string] = id
+        return id
+
+    def __getitem__(self, id):
+        return self.strings[id]
+
+
+class Catalog():
+    """
+    compact list of images, fields are kept in arrays with interned strings
+    instead of a dictionary per image and descriptions are only loaded
+    when an image is requested by its id
+
+    indexing returns complete dictionaries following schema/image.json,
+    iterating leaves out the descriptions so going over all images
+    doesn't load them
+    """
+
+    separator = "\x00"
+    # number of loaded descriptions that are kept
+    cache_size = 256
+
+    def __init__(self, loader=None):
+        """
+        :param loader: function returning the stored dictionary of an image
+                       by its id, used to load descriptions
+        """
+        self.loader = loader
+        self.strings = StringTable()
+        self.sources = array('I')
+        self.paths = array('I')
+        self.handles = array('I')
+        self.names = array('I')
+        self.posted = array('I')
+        self.cws = array('I')
+        self.phashes = array('Q')
+        self.flags = bytearray()
+        # rarely used fields only exist for the images that have them
+        self.more_phashes = {}
+        self.additional = {}
+        self.extras = {}
+        self.lock = threading.Lock()
+        self.descriptions = OrderedDict()
+
+    def __len__(self):
+        return len(self.sources)
+
+    def pack(self, image):
+        """
+        :return: tuple with the packed fields of an image
+        """
+        strings = self.strings
+        flags = 0
+        handle = name = 0
+        author = image.get("author")
+        if author is not None:
+            if set(author) <= {"handle", "name"}:
+                flags |= AUTHOR
+                handle = strings.add(author.get("handle"))
+                name = strings.add(author.get("name"))
+        if "nsfw" in image:
+            flags |= NSFW_SET
+            if image["nsfw"]:
+                flags |= NSFW
+        if "description" in image:
+            flags |= DESCRIPTION
+        phash = 0
+        if image.get("phashes"):
+            flags |= PHASH
+            phash = int(image["phashes"][0], 16)
+        extras = {key: value for key, value in image.items() if key not in known}
+        if author is not None and not flags & AUTHOR:
+            extras["author"] = author
+        return (strings.add(image["source"]),
+                strings.add(self.separator.join(image["image_paths"])),
+                handle, name,
+                strings.add(image.get("posted")),
+                strings.add(image.get("cw")),
+                phash, flags,
+                image.get("phashes", [])[1:],
+                image.get("additional"),
+                extras)
+
+    def store(self, index, image):
+        (source, paths, handle, name, posted, cw, phash, flags,
+         more_phashes, additional, extras) = self.pack(image)
+        if index == len(self):
+            self.sources.append(source)
+            self.paths.append(paths)
+            self.handles.append(handle)
+            self.names.append(name)
+            self.posted.append(posted)
+            self.cws.append(cw)
+            self.phashes.append(phash)
+            self.flags.append(flags)
+        else:
+            self.sources[index] = source
+            self.paths[index] = paths
+            self.handles[index] = handle
+            self.names[index] = name
+            self.posted[index] = posted
+            self.cws[index] = cw
+            self.phashes[index] = phash
+            self.flags[index] = flags
+        for field, value in ((self.more_phashes, more_phashes),
+                             (self.additional, additional),
+                             (self.extras, extras)):
+            if value:
+                field[index] = value
+            else:
+                field.pop(index, None)
+        if "description" in image:
+            self.cache_description(index, image["description"])
+
+    def append(self, image):
+        self.store(len(self), image)
+
+    def extend(self, images):
+        for image in images:
+            self.append(image)
+
+    def __setitem__(self, index, image):
+        if index >= len(self):
+            raise IndexError(index)
+        self.store(index, image)
+
+    def cache_description(self, index, description):
+        with self.lock:
+            self.descriptions[index] = description
+            self.descriptions.move_to_end(index)
+            while len(self.descriptions) > self.cache_size:
+                self.descriptions.popitem(last=False)
+
+    def description(self, index):
+        with self.lock:
+            description = self.descriptions.get(index)
+        if description is None:
+            description = self.loader(index).get("description", "")
+            self.cache_description(index, description)
+        return description
+
+    def summary(self, index):
+        """
+        :return: dictionary of the image without its description
+        """
+        strings = self.strings
+        flags = self.flags[index]
+        image = {"source": strings[self.sources[index]],
+                 "image_paths": strings[self.paths[index]].split(self.separator)}
+        if flags & AUTHOR:
+            author = {}
+            if self.handles[index]:
+                author["handle"] = strings[self.handles[index]]
+            if self.names[index]:
+                author["name"] = strings[self.names[index]]
+            image["author"] = author
+        if flags & NSFW_SET:
+            image["nsfw"] = bool(flags & NSFW)
+        if self.cws[index]:
+            image["cw"] = strings[self.cws[index]]
+        if self.posted[index]:
+            image["posted"] = strings[self.posted[index]]
+        if index in self.additional:
+            image["additional"] = list(self.additional[index])
+        if flags & PHASH:
+            image["phashes"] = ["{:016x}".format(self.phashes[index])] + \
+                list(self.more_phashes.get(index, []))
+        for key, value in self.extras.get(index, {}).items():
+            image[key] = value
+        return image
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        image = self.summary(index)
+        if self.flags[index] & DESCRIPTION:
+            image["description"] = self.description(index)
+        return image
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.summary(index)
+
+
+class SourceIndex():
+    """
+    finds the ids of images by a key of their source, like a dictionary
+    of keys to ids, but only a hash of every key is kept in a sorted
+    array and the key of a found image is checked against its source in
+    the catalog
+    """
+
+    def __init__(self, catalog, key):
+        """
+        :param catalog: Catalog with the images
+        :param key: function turning a source into its key
+        """
+        self.catalog = catalog
+        self.key = key
+        self.hashes = array('q')
+        self.ids = array('I')
+
+    def source(self, index):
+        return self.catalog.strings[self.catalog.sources[index]]
+
+    def build(self):
+        """
+        index all images of the catalog
+        """
+        hashes = array('q', (hash(self.key(self.source(index)))
+                             for index in range(len(self.catalog))))
+        order = sorted(range(len(hashes)), key=hashes.__getitem__)
+        self.hashes = array('q', (hashes[index] for index in order))
+        self.ids = array('I', order)
+
+    def add(self, index):
+        """
+        call after the image was stored in the catalog
+        """
+        value = hash(self.key(self.source(index)))
+        position = bisect_right(self.hashes, value)
+        self.hashes.insert(position, value)
+        self.ids.insert(position, index)
+
+    def remove(self, index):
+        """
+        call before the image is changed in the catalog
+        """
+        value = hash(self.key(self.source(index)))
+        position = bisect_left(self.hashes, value)
+        while position < len(self.hashes) and self.hashes[position] == value:
+            if self.ids[position] == index:
+                del self.hashes[position]
+                del self.ids[position]
+                return
+            position += 1
+
+    def get(self, key):
+        """
+        :return: id of an image with the key or None
+        """
+        value = hash(key)
+        position = bisect_left(self.hashes, value)
+        while position < len(self.hashes) and self.hashes[position] == value:
+            index = self.ids[position]
+            if self.key(self.source(index)) == key:
+                return index
+            position += 1
+        return None
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.ids)
@@ -0,0 +1,225 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from storage import FileLock
+
+
+logger = logging.getLogger("bot")
+
+
+def empty_stats():
+    return {"posts": 0, "boosts": 0, "first": None, "last": None,
+            "latency": 0.0, "max_latency": 0.0}
+
+
+def add_record(stats, record):
+    """
+    add a single post to the stats of its image
+    """
+    if record["boost"]:
+        stats["boosts"] += 1
+    else:
+        stats["posts"] += 1
+    if stats["first"] is None or record["time"] < stats["first"]:
+        stats["first"] = record["time"]
+    if stats["last"] is None or record["time"] > stats["last"]:
+        stats["last"] = record["time"]
+    stats["latency"] += record["latency"]
+    stats["max_latency"] = max(stats["max_latency"], record["latency"])
+
+
+def merge(stats, other):
+    stats["posts"] += other["posts"]
+    stats["boosts"] += other["boosts"]
+    for key, pick in (("first", min), ("last", max)):
+        values = [value for value in (stats[key], other[key]) if value is not None]
+        stats[key] = pick(values) if values else None
+    stats["latency"] += other["latency"]
+    stats["max_latency"] = max(stats["max_latency"], other["max_latency"])
+
+
+class History():
+    """
+    append-only log of every toot, old entries are compacted into per
+    image totals so the log doesn't grow forever
+    """
+
+    # entries older than this many seconds are compacted
+    keep = 30 * 24 * 60 * 60
+    # appends between two compactions
+    compact_every = 1000
+
+    def __init__(self, path):
+        """
+        :param path: string with the path to the json lines log, the
+                     totals are kept next to it with .summary.json
+        """
+        self.path = path
+        self.summary_path = os.path.splitext(path)[0] + ".summary.json"
+        self.lock = threading.Lock()
+        # other processes posting append to the same log
+        self.file_lock = FileLock(path + ".lock")
+        self.appended = 0
+        # number of toots and time of the last toot per image
+        self.counts = {}
+        # inode of the log, stat of the summary, the read position and
+        # the time the summary was compacted until
+        self.position = None
+        self.refresh()
+
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def refresh(self):
+        """
+        update counts with the toots appended since the last call, by this
+        or other processes, compacting starts over from the summary
+        :return: set of ids of the images whose counts changed
+        """
+        with self.lock, self.file_lock:
+            summary = self.stat(self.summary_path)
+            try:
+                log = open(self.path, 'rb')
+            except FileNotFoundError:
+                log = None
+            inode = os.fstat(log.fileno()).st_ino if log is not None else None
+            changed = set()
+            if self.position is None or self.position[:2] != (inode, summary):
+                changed.update(self.counts)
+                until, images = self.load_summary()
+                self.counts = {index: (stats["posts"] + stats["boosts"], stats["last"])
+                               for index, stats in images.items()}
+                changed.update(self.counts)
+                offset = 0
+            else:
+                offset, until = self.position[2:]
+            if log is not None:
+                with log:
+                    log.seek(offset)
+                    for line in log:
+                        # a crash can leave a half written last line
+                        if not line.endswith(b"\n"):
+                            break
+                        offset += len(line)
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if record["time"] < until:
+                            continue
+                        count, last = self.counts.get(record["image"], (0, None))
+                        self.counts[record["image"]] = (
+                            count + 1, max(last or record["time"], record["time"]))
+                        changed.add(record["image"])
+            self.position = (inode, summary, offset, until)
+        return changed
+
+    def append(self, index, url, boost, latency):
+        """
+        counts are updated by the next refresh
+        :param index: id of the posted image
+        :param url: string with the url of the toot
+        :param boost: True if the toot was boosted instead of posted
+        :param latency: seconds from choosing the image until it was posted
+        """
+        with self.lock, self.file_lock:
+            # the time is taken while holding the lock, so a compaction
+            # never cuts off entries written after it
+            record = {"image": index, "url": url, "time": time.time(),
+                      "boost": boost, "latency": round(latency, 3)}
+            line = json.dumps(record, separators=(",", ":")) + "\n"
+            with open(self.path, 'a') as log:
+                log.write(line)
+            self.appended += 1
+            compact = self.appended >= self.compact_every
+        if compact:
+            self.compact()
+
+    def load_summary(self):
+        """
+        :return: tuple with the time the log was compacted until and a
+                 dictionary of image ids to their compacted stats
+        """
+        try:
+            with open(self.summary_path) as data:
+                summary = json.load(data)
+        except FileNotFoundError:
+            return 0, {}
+        return summary["until"], {int(index): stats
+                                  for index, stats in summary["images"].items()}
+
+    def records(self, since=0):
+        """
+        stream the entries of the log one by one
+        :param since: unix time, older entries are skipped
+        """
+        try:
+            log = open(self.path)
+        except FileNotFoundError:
+            return
+        with log:
+            for line in log:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a crash can leave a half written last line
+                    logger.debug("skipping broken history line")
+                    continue
+                if record["time"] >= since:
+                    yield record
+
+    def stats(self):
+        """
+        :return: dictionary of image ids to their stats over the whole history
+        """
+        until, images = self.load_summary()
+        for record in self.records(since=until):
+            add_record(images.setdefault(record["image"], empty_stats()), record)
+        return images
+
+    def compact(self, now=None):
+        """
+        move entries older than keep seconds from the log into the summary
+        """
+        with self.lock, self.file_lock:
+            self.appended = 0
+            until, images = self.load_summary()
+            cutoff = (now or time.time()) - self.keep
+            tmp_path = self.path + ".tmp"
+            kept = 0
+            with open(tmp_path, 'w') as output:
+                for record in self.records(since=until):
+                    if record["time"] < cutoff:
+                        add_record(images.setdefault(record["image"], empty_stats()), record)
+                    else:
+                        output.write(json.dumps(record, separators=(",", ":")) + "\n")
+                        kept += 1
+            # the summary is written first, entries before its time are
+            # skipped so a crash in between doesn't count them twice
+            summary_tmp = self.summary_path + ".tmp"
+            with open(summary_tmp, 'w') as output:
+                json.dump({"until": max(until, cutoff), "images": images}, output)
+            os.replace(summary_tmp, self.summary_path)
+            os.replace(tmp_path, self.path)
+        logger.debug("history compacted, {} entries kept".format(kept))
+
+    def report(self, source_of):
+        """
+        :param source_of: function returning the source type of an image id
+        :return: tuple with a dictionary of source types to their stats and
+                 the dictionary of image ids to their stats
+        """
+        images = self.stats()
+        sources = {}
+        for index, stats in images.items():
+            total = sources.setdefault(source_of(index), dict(empty_stats(), images=0))
+            merge(total, stats)
+            total["images"] += 1
+        return sources, images
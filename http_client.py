@@ -0,0 +1,113 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger("bot")
+user_agent = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:20.0) Gecko/20100101 Firefox/20.0'
+
+
+class RateLimiter():
+    """
+    keeps a minimum interval between two requests to the same host
+    """
+
+    def __init__(self, intervals=None, default=0):
+        """
+        :param intervals: dictionary with the seconds between requests per host
+        :param default: seconds between requests for all other hosts
+        """
+        self.intervals = intervals or {}
+        self.default = default
+        self.lock = threading.Lock()
+        self.next_request = {}
+
+    def wait(self, host):
+        interval = self.intervals.get(host, self.default)
+        if not interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_request.get(host, now))
+            self.next_request[host] = at + interval
+        if at > now:
+            logger.debug("waiting {:.2f}s for {}".format(at - now, host))
+            time.sleep(at - now)
+
+
+def retry_adapter(retries=3, backoff=1, pool_size=16):
+    """
+    :param retries: number of retries on connection errors, 429 and 5xx
+    :param backoff: base in seconds for the exponential backoff
+    :param pool_size: number of kept alive connections per host
+    :return: adapter that can be mounted on any requests session
+    """
+    retry = Retry(total=retries,
+                  backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  respect_retry_after_header=True,
+                  raise_on_status=False)
+    return HTTPAdapter(max_retries=retry,
+                       pool_connections=pool_size,
+                       pool_maxsize=pool_size)
+
+
+class Session(requests.Session):
+    """
+    requests session with connection pooling, retries, a default timeout
+    and per host rate limits
+    """
+
+    def __init__(self, timeout=30, retries=3, backoff=1, rate_limits=None,
+                 rate_limit=0, pool_size=16):
+        super().__init__()
+        self.timeout = timeout
+        self.limiter = RateLimiter(rate_limits, rate_limit)
+        self.headers['User-Agent'] = user_agent
+        adapter = retry_adapter(retries, backoff, pool_size)
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        self.limiter.wait(urlsplit(url).netloc)
+        return super().request(method, url, **kwargs)
+
+
+session = Session()
+# http settings of the first configured bot
+configured = False
+
+
+def configure(settings):
+    """
+    replace the shared session with one using the http settings of a config,
+    all bots in one process share the session of the first configured bot
+    :param settings: http settings from the config, see schema/config.json,
+                     None keeps the default settings
+    """
+    global session, configured
+    if configured is not False:
+        if settings != configured:
+            logger.warning("http settings differ, keeping the first ones")
+        return
+    configured = settings
+    if settings is None:
+        return
+    kwargs = {}
+    for key in ("timeout", "retries", "backoff", "rate_limit"):
+        try:
+            kwargs[key] = getattr(settings, key)
+        except AttributeError:
+            pass
+    try:
+        kwargs["rate_limits"] = {limit.host: limit.interval
+                                 for limit in settings.rate_limits}
+    except AttributeError:
+        pass
+    session = Session(**kwargs)
@@ -0,0 +1,265 @@
+import re
+from array import array
+from bisect import bisect_left
+from itertools import compress
+
+from resolvers import source_type
+
+
+re_hashtag = re.compile(r"#(\w+)")
+fields = ("tag", "author", "nsfw", "source", "posted")
+# fields every image has and their possible values
+dense = {
+    "nsfw": ("true", "false"),
+    "posted": ("true", "false"),
+    "source": ("twitter", "danbooru", "pixiv", "mastodon", "other")
+}
+# bits of ImageIndex.codes, the source type is stored above them
+PRESENT = 1
+NSFW = 2
+POSTED = 4
+SOURCE_SHIFT = 3
+
+
+def hashtags(text):
+    """
+    :param text: string like the descriptions of the resolvers
+    :return: list of the lowercase hashtags in the text without the #
+    """
+    return [tag.lower() for tag in re_hashtag.findall(text or "")]
+
+
+def normalize(field, value):
+    value = str(value).strip().lower()
+    if field == "tag":
+        return value.lstrip("#")
+    if field == "author":
+        return value.lstrip("@")
+    if field in ("nsfw", "posted"):
+        if value in ("true", "yes", "1"):
+            return "true"
+        if value in ("false", "no", "0"):
+            return "false"
+        raise ValueError("{} has to be true or false, not {}".format(field, value))
+    return value
+
+
+def parse_query(text):
+    """
+    terms are field:value pairs, terms of the same field match any of their
+    values, different fields all have to match and a leading - excludes
+    matching images, e.g. "tag:touhou tag:original nsfw:false -posted:true"
+    :param text: string with the query
+    :return: tuple with a dictionary of fields to sets of values and a set
+             of excluded (field, value) pairs
+    """
+    include = {}
+    exclude = set()
+    for term in text.split():
+        negate = term.startswith("-")
+        field, sep, value = term.lstrip("-").partition(":")
+        if not sep or field not in fields or not value:
+            raise ValueError("invalid term '{}', use one of {} like tag:value".format(
+                term, ", ".join(fields)))
+        value = normalize(field, value)
+        if negate:
+            exclude.add((field, value))
+        else:
+            include.setdefault(field, set()).add(value)
+    return include, exclude
+
+
+def keys(image):
+    """
+    :param image: dictionary following schema/image.json
+    :return: set of (field, value) pairs the image is found by
+    """
+    found = {("tag", tag) for tag in hashtags(image.get("description"))}
+    author = image.get("author", {})
+    for value in (author.get("handle"), author.get("name")):
+        if value:
+            found.add(("author", normalize("author", value)))
+    found.add(("nsfw", normalize("nsfw", bool(image.get("nsfw")))))
+    found.add(("source", source_type(image["source"])))
+    found.add(("posted", normalize("posted", "posted" in image)))
+    return found
+
+
+def encode(found):
+    """
+    :param found: result of keys
+    :return: byte with the dense fields of an image
+    """
+    code = PRESENT
+    if ("nsfw", "true") in found:
+        code |= NSFW
+    if ("posted", "true") in found:
+        code |= POSTED
+    for index, value in enumerate(dense["source"]):
+        if ("source", value) in found:
+            code |= index << SOURCE_SHIFT
+    return code
+
+
+def decode(code, field):
+    """
+    :return: normalized value of a dense field in the code of an image
+    """
+    if field == "nsfw":
+        return "true" if code & NSFW else "false"
+    if field == "posted":
+        return "true" if code & POSTED else "false"
+    sources = dense["source"]
+    return sources[code >> SOURCE_SHIFT] if code >> SOURCE_SHIFT < len(sources) else None
+
+
+def table(include, exclude):
+    """
+    :param include: dictionary of dense fields to sets of values
+    :param exclude: list of excluded (field, value) pairs of dense fields
+    :return: translation table turning the codes of matching images into 1
+    """
+    return bytes(int(bool(code & PRESENT) and
+                     all(decode(code, field) in values for field, values in include.items()) and
+                     not any(decode(code, field) == value for field, value in exclude))
+                 for code in range(256))
+
+
+class ImageIndex():
+    """
+    inverted index from tags, authors, nsfw, source type and posted state
+    to the ids of the images
+
+    tags and authors map to sorted arrays of ids, the fields every image
+    has are packed into one byte per image instead, those bytes are
+    matched with a translation table so queries don't loop over them
+    """
+
+    def __init__(self):
+        # (field, value) tuples of tags and authors to sorted arrays of ids
+        self.postings = {}
+        # PRESENT, NSFW, POSTED and the source type by image id
+        self.codes = bytearray()
+
+    @property
+    def size(self):
+        return len(self.codes)
+
+    def build(self, images):
+        self.postings = {}
+        self.codes = bytearray()
+        for index, image in enumerate(images):
+            self.add(index, image)
+
+    def add(self, index, image):
+        found = keys(image)
+        if index >= len(self.codes):
+            # gaps are left without PRESENT, so they never match
+            self.codes.extend(bytes(index + 1 - len(self.codes)))
+        self.codes[index] = encode(found)
+        for key in found:
+            if key[0] in dense:
+                continue
+            postings = self.postings.get(key)
+            if postings is None:
+                self.postings[key] = array('I', [index])
+            elif postings[-1] < index:
+                postings.append(index)
+            else:
+                position = bisect_left(postings, index)
+                if position == len(postings) or postings[position] != index:
+                    postings.insert(position, index)
+
+    def remove(self, index, image):
+        """
+        call before an image is changed and add it again afterwards, an
+        image without its description, like Catalog.summary returns, has
+        its tags looked up in every tag
+        """
+        if index < len(self.codes):
+            self.codes[index] = 0
+        if "description" in image:
+            found = [key for key in keys(image) if key[0] not in dense]
+        else:
+            found = [key for key in keys(image) if key[0] == "author"] + \
+                [key for key in self.postings if key[0] == "tag"]
+        for key in found:
+            postings = self.postings.get(key)
+            if postings is None:
+                continue
+            position = bisect_left(postings, index)
+            if position < len(postings) and postings[position] == index:
+                del postings[position]
+                if not postings:
+                    del self.postings[key]
+
+    def ids(self, table):
+        """
+        :param table: translation table turning codes into 1 or 0
+        :return: set of the ids of the images with a code turned into 1
+        """
+        return set(compress(range(len(self.codes)), self.codes.translate(table)))
+
+    def get(self, field, value):
+        """
+        :return: new set of ids of the images
+        """
+        value = normalize(field, value)
+        if field in dense:
+            return self.ids(table({field: {value}}, ()))
+        return set(self.postings.get((field, value), ()))
+
+    def values(self, field):
+        """
+        :return: dictionary with every value of the field and its number of images
+        """
+        if field in dense:
+            counts = {}
+            for value in dense[field]:
+                count = self.codes.translate(table({field: {value}}, ())).count(1)
+                if count:
+                    counts[value] = count
+            return counts
+        return {value: len(postings) for (key, value), postings in self.postings.items()
+                if key == field}
+
+    def query(self, query):
+        """
+        :param query: string or the result of parse_query
+        :return: set of ids of the matching images
+        """
+        include, exclude = parse_query(query) if isinstance(query, str) else query
+        # all terms of the dense fields are checked with one table
+        accepted = table({field: values for field, values in include.items()
+                          if field in dense},
+                         [key for key in exclude if key[0] in dense])
+        result = None
+        # start with the smallest field to keep the intersections small
+        groups = [set().union(*(self.postings.get((field, value), ())
+                                for value in values))
+                  for field, values in include.items() if field not in dense]
+        for group in sorted(groups, key=len):
+            result = group if result is None else result & group
+            if not result:
+                return set()
+        if result is None:
+            result = self.ids(accepted)
+        else:
+            codes = self.codes
+            result = {index for index in result if accepted[codes[index]]}
+        for key in exclude:
+            if key[0] not in dense:
+                result.difference_update(self.postings.get(key, ()))
+        return result
+
+    def matches(self, query, image):
+        """
+        :param query: result of parse_query
+        :param image: dictionary following schema/image.json
+        :return: True if the image matches the query
+        """
+        include, exclude = query
+        found = keys(image)
+        return all(any((field, value) in found for value in values)
+                   for field, values in include.items()) and \
+            not any(key in found for key in exclude)
@@ -0,0 +1,483 @@
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import posixpath
+import shutil
+import subprocess
+import tempfile
+from array import array
+from urllib.parse import urlsplit
+
+import requests
+
+import http_client
+import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import fcntl
+except ImportError:
+    # windows has no flock, downloads of the same url aren't coordinated there
+    fcntl = None
+
+
+logger = logging.getLogger("bot")
+
+
+def extension(url, content_type=None):
+    """
+    :param url: string with the url to the file
+    :param content_type: content type of the response, used if the url has no extension
+    :return: string with the file extension including the dot
+    """
+    ext = posixpath.splitext(urlsplit(url).path)[1].lower()
+    if not ext and content_type:
+        ext = mimetypes.guess_extension(content_type.split(";")[0]) or ""
+    if ext == ".jpeg" or ext == ".jpe":
+        ext = ".jpg"
+    return ext
+
+
+class IncompleteDownload(IOError):
+    pass
+
+
+# first bytes of the supported file types
+file_signatures = {
+    ".jpg": [(0, b"\xff\xd8\xff")],
+    ".png": [(0, b"\x89PNG\r\n\x1a\n")],
+    ".gif": [(0, b"GIF87a"), (0, b"GIF89a")],
+    ".webm": [(0, b"\x1a\x45\xdf\xa3")],
+    ".mp4": [(4, b"ftyp")],
+    ".mov": [(4, b"ftyp"), (4, b"moov"), (4, b"wide")]
+}
+
+
+def check_header(path, ext):
+    """
+    :param path: string with the path to the file
+    :param ext: string with the file extension including the dot
+    :return: False if the file doesn't start like a file of its type or
+             Pillow can't read the image, unknown types are always accepted
+    """
+    if ext not in file_signatures:
+        return True
+    with open(path, 'rb') as data:
+        header = data.read(16)
+    if not any(header[offset:offset + len(signature)] == signature
+               for offset, signature in file_signatures[ext]):
+        return False
+    if Image is None or ext in video_extensions:
+        return True
+    # catches images that are cut off or broken in the middle
+    try:
+        with Image.open(path) as img:
+            img.verify()
+    except (OSError, ValueError, SyntaxError):
+        return False
+    return True
+
+
+class MediaStore():
+    """
+    stores files by the sha256 of their content, so the same file from
+    different sources is only kept once
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, root="images"):
+        self.root = root
+        self.tmp = os.path.join(root, "tmp")
+
+    def path(self, digest, ext):
+        return "{}/{}/{}{}".format(self.root, digest[:2], digest, ext)
+
+    def download(self, url, headers=None, attempts=3):
+        """
+        downloads into a partial file first, interrupted downloads are
+        resumed with a range request
+        :param url: string with the url to the file
+        :param headers: additional request headers
+        :param attempts: number of tries before giving up on broken connections
+        :return: string with the path to the stored file
+        """
+        os.makedirs(self.tmp, exist_ok=True)
+        part_path = os.path.join(
+            self.tmp, hashlib.sha1(url.encode()).hexdigest() + ".part")
+        host = urlsplit(url).netloc
+        with self.lock_part(part_path), metrics.download_time.time(host=host):
+            try:
+                for attempt in range(1, attempts + 1):
+                    try:
+                        ext, digest = self.fetch(url, part_path, headers)
+                        break
+                    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                            IncompleteDownload) as e:
+                        logger.warning("download of {} interrupted ({}/{}): {}".format(
+                            url, attempt, attempts, repr(e)))
+                        if attempt == attempts:
+                            raise
+            except BaseException:
+                # nothing to resume, the lock created an empty file
+                if not os.path.getsize(part_path):
+                    self.remove(part_path)
+                    self.remove(part_path + ".validator")
+                raise
+            metrics.download_size.observe(os.path.getsize(part_path), host=host)
+            self.remove(part_path + ".validator")
+            if not check_header(part_path, ext):
+                os.remove(part_path)
+                raise ValueError("{} isn't a valid {} file".format(url, ext))
+            return self.publish(part_path, digest, ext)
+
+    def lock_part(self, part_path):
+        """
+        lock the partial file of a url, so only one thread or process
+        downloads it at a time
+        :return: the open partial file, closing it releases the lock
+        """
+        while True:
+            lock = open(part_path, 'ab')
+            if fcntl is None:
+                return lock
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # the file was published while waiting, lock the new one
+                if os.fstat(lock.fileno()).st_ino == os.stat(part_path).st_ino:
+                    return lock
+            except FileNotFoundError:
+                pass
+            lock.close()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def fetch(self, url, part_path, headers=None):
+        """
+        :return: tuple with the file extension and the sha256 of the file
+        """
+        headers = dict(headers or {})
+        # sizes have to match the bytes on disk
+        headers['Accept-Encoding'] = 'identity'
+        digest = hashlib.sha256()
+        validator_path = part_path + ".validator"
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        validator = None
+        if offset and os.path.isfile(validator_path):
+            with open(validator_path) as data:
+                validator = data.read()
+        # only resume if the server can tell that the file didn't change,
+        # otherwise it sends the whole file again
+        if validator:
+            headers['Range'] = "bytes={}-".format(offset)
+            headers['If-Range'] = validator
+        with http_client.session.get(url, headers=headers, stream=True) as response:
+            if response.status_code == 416:
+                # the partial file can't be resumed, start over
+                self.remove(validator_path)
+                open(part_path, 'wb').close()
+                return self.fetch(url, part_path, headers={
+                    key: value for key, value in headers.items()
+                    if key not in ('Range', 'If-Range')})
+            response.raise_for_status()
+            ext = extension(url, response.headers.get("Content-Type"))
+            if response.status_code == 206:
+                if not response.headers.get("Content-Range", "").startswith(
+                        "bytes {}-".format(offset)):
+                    self.remove(validator_path)
+                    open(part_path, 'wb').close()
+                    raise IncompleteDownload("server sent another range than requested")
+                logger.info("resuming download at {} bytes".format(offset))
+                # hash what is already there so the file isn't read again
+                with open(part_path, 'rb') as data:
+                    for chunk in iter(lambda: data.read(self.chunk_size), b''):
+                        digest.update(chunk)
+                mode = 'ab'
+            else:
+                offset = 0
+                mode = 'wb'
+                self.save_validator(validator_path, response.headers)
+            expected = response.headers.get("Content-Length")
+            with open(part_path, mode) as out_file:
+                for chunk in response.iter_content(self.chunk_size):
+                    digest.update(chunk)
+                    out_file.write(chunk)
+        if expected is not None and os.path.getsize(part_path) != offset + int(expected):
+            raise IncompleteDownload("got {} of {} bytes".format(
+                os.path.getsize(part_path) - offset, expected))
+        return ext, digest.hexdigest()
+
+    def save_validator(self, validator_path, headers):
+        """
+        keep the etag or modification time of a new download, a resumed
+        download sends it with If-Range
+        """
+        validator = headers.get("ETag")
+        # weak etags can't be used to resume
+        if not validator or validator.startswith("W/"):
+            validator = headers.get("Last-Modified")
+        if validator:
+            with open(validator_path, 'w') as data:
+                data.write(validator)
+        else:
+            self.remove(validator_path)
+
+    def write(self, data, ext):
+        """
+        :param data: bytes of the file
+        :param ext: string with the file extension including the dot
+        :return: string with the path to the stored file
+        """
+        os.makedirs(self.tmp, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp)
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                out_file.write(data)
+            return self.publish(tmp_path, hashlib.sha256(data).hexdigest(), ext)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def publish(self, tmp_path, digest, ext):
+        """
+        atomically move a finished file to its final path
+        :return: string with the path to the stored file
+        """
+        path = self.path(digest, ext)
+        if os.path.isfile(path):
+            logger.info("file already stored")
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return path
+
+
+def download_image(url, headers=None):
+    """
+    :param url: string with the url to the image
+    :param headers: additional request headers
+    :return: string with the path to the saved image
+    """
+    logger.info("downloading image...")
+    file_path = store.download(url, headers=headers)
+    logger.info("image downloaded!")
+
+    return file_path
+
+
+def file_digest(path):
+    """
+    :param path: string with the path to the file
+    :return: string with the sha256 of the file content
+    """
+    name = posixpath.splitext(posixpath.basename(path))[0]
+    # files in the store are already named by their hash
+    if len(name) == 64 and path.startswith(store.root + "/"):
+        return name
+    digest = hashlib.sha256()
+    with open(path, 'rb') as data:
+        for chunk in iter(lambda: data.read(MediaStore.chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def perceptual_hash(path):
+    """
+    difference hash of an image, similar images have similar hashes
+    :param path: string with the path to the image
+    :return: string with 16 hex digits or None if the file isn't a
+             readable image or Pillow isn't installed
+    """
+    if Image is None:
+        return None
+    try:
+        with Image.open(path) as img:
+            img = img.convert("L").resize((9, 8), Image.LANCZOS)
+    except (OSError, ValueError):
+        return None
+    pixels = list(img.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = bits << 1 | (left > right)
+    return "{:016x}".format(bits)
+
+
+class PerceptualIndex():
+    """
+    finds images whose perceptual hashes differ in at most a few bits
+
+    the hashes are split into distance + 1 bands, two hashes within the
+    distance have at least one band in common, so only hashes sharing a
+    band have to be compared
+    """
+
+    bits = 64
+
+    def __init__(self):
+        # hashes and the ids of their images in the order they were added
+        self.values = array('Q')
+        self.ids = array('I')
+        # lists of band tables by distance, built on the first search
+        self.tables = {}
+
+    def split(self, value, distance):
+        """
+        :return: list with the value of every band of the hash
+        """
+        count = distance + 1
+        bands = []
+        start = 0
+        for band in range(count):
+            end = self.bits * (band + 1) // count
+            bands.append(value >> start & ((1 << (end - start)) - 1))
+            start = end
+        return bands
+
+    def add(self, phash, index):
+        position = len(self.values)
+        value = int(phash, 16)
+        self.values.append(value)
+        self.ids.append(index)
+        for distance, tables in self.tables.items():
+            for table, band in zip(tables, self.split(value, distance)):
+                table.setdefault(band, []).append(position)
+
+    def find(self, phash, distance):
+        """
+        :param phash: string with the perceptual hash to look for
+        :param distance: maximum number of differing bits
+        :return: id of the first similar image or None
+        """
+        value = int(phash, 16)
+        # narrow bands match almost everything, a scan is faster then
+        if distance + 1 > self.bits // 4:
+            for other, index in zip(self.values, self.ids):
+                if bin(value ^ other).count("1") <= distance:
+                    return index
+            return None
+        if distance not in self.tables:
+            tables = [{} for _ in range(distance + 1)]
+            for position, other in enumerate(self.values):
+                for table, band in zip(tables, self.split(other, distance)):
+                    table.setdefault(band, []).append(position)
+            self.tables[distance] = tables
+        first = None
+        for table, band in zip(self.tables[distance], self.split(value, distance)):
+            # positions are in the order the hashes were added
+            for position in table.get(band, ()):
+                if first is not None and position >= first:
+                    break
+                if bin(value ^ self.values[position]).count("1") <= distance:
+                    first = position
+                    break
+        return None if first is None else self.ids[first]
+
+
+store = MediaStore()
+
+
+# upload limits used if the instance doesn't report its own
+default_limits = {
+    "image_size": 8 * 1024 * 1024,
+    "video_size": 40 * 1024 * 1024,
+    "image_pixels": 3840 * 2160
+}
+video_extensions = (".mp4", ".webm", ".mov")
+# videos that would need a lower bitrate are too long to transcode
+min_video_bitrate = 100 * 1000
+
+
+def prepare_file(path, limits):
+    """
+    recompresses or transcodes a file so it fits the upload limits of the
+    instance, runs in worker processes so it has to stay a plain function
+    :param path: string with the path to the file
+    :param limits: dictionary like default_limits
+    :return: string with the path to a file within the limits, this is the
+             original path if it already fit
+    """
+    ext = posixpath.splitext(path)[1].lower()
+    if ext in video_extensions:
+        return prepare_video(path, limits)
+    return prepare_image(path, limits)
+
+
+def prepare_image(path, limits):
+    if Image is None:
+        logger.debug("Pillow isn't installed, can't resize " + path)
+        return path
+    size = os.path.getsize(path)
+    with Image.open(path) as img:
+        pixels = img.width * img.height
+        if size <= limits["image_size"] and pixels <= limits["image_pixels"]:
+            return path
+        # mastodon turns animated images into videos itself
+        if getattr(img, "is_animated", False):
+            return path
+        img.load()
+        if pixels > limits["image_pixels"]:
+            scale = (limits["image_pixels"] / pixels) ** 0.5
+            img = img.resize((int(img.width * scale), int(img.height * scale)),
+                             Image.LANCZOS)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        # lower the quality first, then the resolution until it fits
+        while True:
+            for quality in (90, 80, 70):
+                data = io.BytesIO()
+                img.save(data, "JPEG", quality=quality, optimize=True)
+                if data.tell() <= limits["image_size"]:
+                    return store.write(data.getvalue(), ".jpg")
+            img = img.resize((int(img.width * 0.75), int(img.height * 0.75)),
+                             Image.LANCZOS)
+
+
+def prepare_video(path, limits):
+    if os.path.getsize(path) <= limits["video_size"]:
+        return path
+    ffmpeg = shutil.which("ffmpeg")
+    ffprobe = shutil.which("ffprobe")
+    if not ffmpeg or not ffprobe:
+        logger.warning("ffmpeg isn't installed, can't transcode " + path)
+        return path
+    duration = float(subprocess.check_output(
+        [ffprobe, "-v", "error", "-show_entries", "format=duration",
+         "-of", "default=noprint_wrappers=1:nokey=1", path]))
+    audio_bitrate = 128 * 1000
+    if duration <= 0:
+        raise ValueError("{} has no duration".format(path))
+    # leave some room for the container
+    bitrate = int(limits["video_size"] * 8 * 0.9 / duration) - audio_bitrate
+    if bitrate < min_video_bitrate:
+        raise ValueError("{} is too long to fit into {} bytes, it would need {} bit/s".format(
+            path, limits["video_size"], bitrate))
+    os.makedirs(store.tmp, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=store.tmp, suffix=".mp4")
+    os.close(fd)
+    try:
+        subprocess.run(
+            [ffmpeg, "-y", "-v", "error", "-i", path,
+             "-c:v", "libx264", "-b:v", str(bitrate),
+             "-maxrate", str(bitrate), "-bufsize", str(bitrate * 2),
+             "-c:a", "aac", "-b:a", str(audio_bitrate),
+             "-movflags", "+faststart", tmp_path],
+            check=True)
+        return store.publish(tmp_path, file_digest(tmp_path), ".mp4")
+    except BaseException:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,239 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger("bot")
+# nothing is recorded until metrics are configured, every observation
+# returns right away while this is False
+enabled = False
+registry = []
+# metrics settings of the first configured bot
+configured = False
+
+
+class Timer():
+    """
+    context manager observing the seconds its block took
+    """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+null_timer = NullTimer()
+
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        """
+        :param name: string with the name of the metric
+        :param help: string describing the metric
+        :param labels: names of the labels every observation has
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for name, value in pairs) + "}"
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            lines.extend(self.samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        if not enabled:
+            return
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, key, value):
+        return ["{}{} {}".format(self.name, self.format_labels(key), value)]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    seconds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help, labels=(), buckets=seconds):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        if not enabled:
+            return
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def time(self, **labels):
+        """
+        :return: context manager timing its block, does nothing if
+                 metrics are disabled
+        """
+        if not enabled:
+            return null_timer
+        return Timer(self, labels)
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(
+                self.name, self.format_labels(key, [("le", str(bound))]), cumulative))
+        lines.append("{}_sum{} {}".format(self.name, self.format_labels(key), total))
+        lines.append("{}_count{} {}".format(self.name, self.format_labels(key), cumulative))
+        return lines
+
+
+def render():
+    """
+    :return: string with all metrics in the prometheus text format
+    """
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, address="127.0.0.1"):
+    """
+    expose the metrics at http://address:port/metrics from a background thread
+    :return: the started http server
+    """
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("serving metrics on {}:{}".format(address, port))
+    return server
+
+
+def write_textfile(path):
+    """
+    write all metrics to a file for the textfile collector of node exporter,
+    the file is replaced atomically so it's never read half written
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as output:
+        output.write(render())
+    os.replace(tmp_path, path)
+
+
+def write_periodically(path, interval):
+    def loop():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError as e:
+                logger.warning("couldn't write metrics: " + repr(e))
+            time.sleep(interval)
+    threading.Thread(target=loop, daemon=True).start()
+
+
+def configure(settings):
+    """
+    enable metrics with the settings of a config, all bots in one process
+    share the metrics of the first configured bot
+    :param settings: metrics settings from the config, see schema/config.json,
+                     None leaves metrics disabled
+    """
+    global enabled, configured
+    if configured is not False:
+        if settings != configured:
+            logger.warning("metrics settings differ, keeping the first ones")
+        return
+    configured = settings
+    if settings is None:
+        return
+    enabled = True
+    port = getattr(settings, "port", None)
+    if port:
+        serve(port, getattr(settings, "address", "127.0.0.1"))
+    textfile = getattr(settings, "textfile", None)
+    if textfile:
+        write_periodically(textfile, getattr(settings, "interval", 15))
+
+
+byte_buckets = tuple(2 ** power for power in range(10, 28, 2))
+db_load = Histogram(
+    "bot_db_load_seconds", "time to load the db", ("bot",))
+db_validate = Histogram(
+    "bot_db_validate_seconds", "time to validate changed db entries", ("bot",))
+download_time = Histogram(
+    "bot_download_seconds", "time to download a file", ("host",))
+download_size = Histogram(
+    "bot_download_bytes", "size of downloaded files", ("host",), byte_buckets)
+upload_time = Histogram(
+    "bot_upload_seconds", "time to upload a file to the instance", ("bot",))
+toot_time = Histogram(
+    "bot_toot_seconds", "time from choosing an image until the toot is saved", ("bot",))
+drift = Histogram(
+    "bot_schedule_drift_seconds", "seconds toots were posted after their slot", ("bot",))
+resolve_errors = Counter(
+    "bot_resolve_errors_total", "sources that couldn't be resolved", ("resolver",))
+toot_errors = Counter(
+    "bot_toot_errors_total", "scheduled toots that failed", ("bot", "error"))
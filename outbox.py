@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+logger = logging.getLogger("bot")
+# every toot goes through these states in order, recorded toots are
+# removed from the outbox
+states = ("selected", "uploaded", "posted", "recorded")
+
+
+class Outbox():
+    """
+    persisted queue of toots that are being posted, every finished step is
+    saved so a failed or interrupted toot continues where it stopped
+    """
+
+    # seconds a process owns a toot without renewing its lease, afterwards
+    # other processes may take it over
+    lease_time = 5 * 60
+
+    def __init__(self, path, table="outbox"):
+        """
+        :param path: string with the path to the sqlite file
+        :param table: name of the table, several bots can share one file
+        """
+        self.table = table
+        # toots are leased to the process working on them
+        self.owner = "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS {} ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, state TEXT NOT NULL, "
+                "toot TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_try REAL NOT NULL, error TEXT, owner TEXT, lease REAL)".format(table))
+            columns = [row[1] for row in self.connection.execute(
+                "PRAGMA table_info({})".format(table))]
+            for column, kind in (("owner", "TEXT"), ("lease", "REAL")):
+                if column not in columns:
+                    self.connection.execute(
+                        "ALTER TABLE {} ADD COLUMN {} {}".format(table, column, kind))
+
+    def add(self, toot, delay=0):
+        """
+        the new toot is leased to this process
+        :param toot: dictionary with the toot, has to be json serializable
+        :param delay: seconds until the toot is due if it isn't finished
+        :return: id of the toot in the outbox
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO {} (state, toot, next_try, owner, lease) "
+                "VALUES (?, ?, ?, ?, ?)".format(self.table),
+                (toot["state"], json.dumps(toot), time.time() + delay,
+                 self.owner, time.time() + self.lease_time))
+        return cursor.lastrowid
+
+    def claim(self, id):
+        """
+        lease a toot to this process unless another process holds it
+        :return: True if this process may work on the toot
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "UPDATE {} SET owner = ?, lease = ? WHERE id = ? AND "
+                "(owner IS NULL OR owner = ? OR lease < ?)".format(self.table),
+                (self.owner, time.time() + self.lease_time, id, self.owner, time.time()))
+        return cursor.rowcount == 1
+
+    def renew(self, ids):
+        """
+        extend the leases of the toots this process is still working on
+        """
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "UPDATE {} SET lease = ? WHERE id = ? AND owner = ?".format(self.table),
+                [(time.time() + self.lease_time, id, self.owner) for id in ids])
+
+    def update(self, id, toot):
+        """
+        save the toot after it finished a step
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE {} SET state = ?, toot = ?, lease = ? WHERE id = ?".format(self.table),
+                (toot["state"], json.dumps(toot), time.time() + self.lease_time, id))
+
+    def failed(self, id, error, delay):
+        """
+        gives up the lease, any process may try the toot again
+        :param error: string describing the error
+        :param delay: seconds until the toot is tried again
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE {} SET attempts = attempts + 1, next_try = ?, error = ?, "
+                "owner = NULL, lease = NULL WHERE id = ?".format(self.table),
+                (time.time() + delay, error, id))
+
+    def attempts(self, id):
+        """
+        :return: number of failed attempts of the toot
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT attempts FROM {} WHERE id = ?".format(self.table),
+                (id,)).fetchone()
+        return row[0] if row else 0
+
+    def resume(self):
+        """
+        make toots that never failed due now if the process working on
+        them stopped renewing their lease
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE {} SET next_try = ? WHERE attempts = 0 AND next_try > ? AND "
+                "(owner IS NULL OR lease < ?)".format(self.table),
+                (time.time(), time.time(), time.time()))
+
+    def remove(self, id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM {} WHERE id = ?".format(self.table), (id,))
+
+    def pending(self, before=None):
+        """
+        :param before: unix time, only toots due until then are returned
+        :return: list of toot dictionaries, oldest first
+        """
+        query = "SELECT id, toot FROM {}".format(self.table)
+        args = ()
+        if before is not None:
+            query += " WHERE next_try <= ?"
+            args = (before,)
+        with self.lock:
+            rows = self.connection.execute(query + " ORDER BY id", args).fetchall()
+        toots = []
+        for id, toot in rows:
+            toot = json.loads(toot)
+            toot["id"] = id
+            toots.append(toot)
+        return toots
+
+    def next_try(self):
+        """
+        :return: unix time the next toot is due or None if the outbox is empty
+        """
+        with self.lock:
+            # toots leased to other processes are due once their lease ran out
+            row = self.connection.execute(
+                "SELECT MIN(CASE WHEN owner IS NOT NULL AND owner != ? AND lease > next_try "
+                "THEN lease ELSE next_try END) FROM {}".format(self.table),
+                (self.owner,)).fetchone()
+        return row[0]
+
+    def close(self):
+        self.connection.close()
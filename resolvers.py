@@ -0,0 +1,350 @@
+import json
+import logging
+import re
+from abc import ABC, abstractmethod
+from urllib import parse
+
+import http_client
+from media import download_image
+
+
+logger = logging.getLogger("bot")
+re_twitter = re.compile(r"https?://twitter\.com/\S+/\d+")
+re_tweet = re.compile(
+    r"https?://(?:www\.|mobile\.)?twitter\.com\/(\S+)/status/(\d+)")
+re_danbooru = re.compile(r"https?://danbooru\.donmai\.us/posts/(\d+)")
+re_pixiv = re.compile(
+    r"https?://(www)?.pixiv.net/member_illust\.php\?mode=medium&illust_id=(\d+)")
+re_pixiv_id = re.compile(r"pixiv\.net/\S*(?:illust_id=|artworks/)(\d+)")
+re_mastodon = re.compile(
+    r"https?://(pawoo\.net|mastodon\.social|mstdn\.jp)/\S+/(\d+)")
+re_link = re.compile(
+    r"^(?:https?://)?[\w.-]+(?:\.[\w\.-]+)+[\w\-\._~:/?#[\]@!\$&'\(\)\*\+,;=.]+$")
+registry = []
+
+
+def get_handle(username, domain="twitter.com"):
+    handle = "@{}@{}".format(username, domain)
+    return handle
+
+
+def source_type(source):
+    """
+    :param source: string with the url to the source
+    :return: twitter, danbooru, pixiv, mastodon or other
+    """
+    if re_twitter.search(source):
+        return "twitter"
+    elif re_danbooru.search(source):
+        return "danbooru"
+    elif re_pixiv_id.search(source):
+        return "pixiv"
+    elif re_mastodon.search(source):
+        return "mastodon"
+    return "other"
+
+
+def register(resolver):
+    """
+    class decorator adding a resolver to the registry, resolvers are
+    tried in the order they were registered
+    """
+    registry.append(resolver())
+    return resolver
+
+
+def find_resolver(bot, source):
+    """
+    :param bot: BotClass the source is added to
+    :param source: string with the url to the source
+    :return: first resolver able to handle the source or None
+    """
+    for resolver in registry:
+        if resolver.matches(bot, source):
+            return resolver
+    return None
+
+
+def get_resolver(name):
+    for resolver in registry:
+        if resolver.name == name:
+            return resolver
+    raise KeyError(name)
+
+
+class Resolver(ABC):
+    """
+    retrieves images and additional info for the urls matched by pattern
+    """
+
+    name = None
+    pattern = None
+    # seconds api responses are cached
+    ttl = 7 * 24 * 60 * 60
+
+    def matches(self, bot, source):
+        return bool(self.pattern.search(source))
+
+    @abstractmethod
+    def resolve(self, bot, source):
+        """
+        :param bot: BotClass the source is added to
+        :param source: string with the url to the source
+        :return: dictionary following schema/image.json
+        """
+
+    def cached(self, bot, key, fetch):
+        """
+        api responses are kept in the cache of the bot, so resolving the
+        same post or user again doesn't need a request
+        :param key: string with the canonical id of the post or user
+        :param fetch: function requesting the data, has to return json
+        """
+        key = "meta:{}:{}".format(self.name, key)
+        data = bot.cache.get(key)
+        if data is None:
+            data = fetch()
+            bot.cache.set(key, data, ttl=self.ttl)
+        else:
+            logger.debug("cached " + key)
+        return data
+
+
+@register
+class MastodonResolver(Resolver):
+    name = "mastodon"
+    pattern = re_mastodon
+
+    def resolve(self, bot, source):
+        # toots are boosted instead of posting the images again
+        return {
+            "source": source,
+            "image_paths": ["mastodon.png"],
+            "author": {
+                "handle": "",
+                "name": ""
+            },
+            "description": "",
+            "nsfw": False
+        }
+
+
+@register
+class TwitterResolver(Resolver):
+    name = "twitter"
+    pattern = re_twitter
+
+    def matches(self, bot, source):
+        return super().matches(bot, source) and bool(bot.tweet_api)
+
+    def best_variant(self, video_info, size_limit):
+        """
+        :param video_info: video_info of a tweet's media
+        :param size_limit: maximum file size in bytes
+        :return: url of the mp4 with the highest bitrate that fits the limit
+        """
+        variants = [variant for variant in video_info['variants']
+                    if variant.get('content_type') == "video/mp4"]
+        if not variants:
+            return video_info['variants'][0]['url']
+        variants.sort(key=lambda variant: variant.get('bitrate', 0), reverse=True)
+        seconds = video_info.get('duration_millis', 0) / 1000
+        for variant in variants:
+            if variant.get('bitrate', 0) / 8 * seconds <= size_limit:
+                return variant['url']
+        # nothing fits, the smallest one is transcoded later
+        return variants[-1]['url']
+
+    def resolve(self, bot, source):
+        nsfw = False
+        paths = []
+        handle = ""
+        name = ""
+        description = ""
+
+        id = source.split('/')[-1]
+        tweet = self.cached(bot, "status:" + id,
+                            lambda: bot.tweet_api.get_status(id)._json)
+        logger.debug(tweet['extended_entities']['media'])
+
+        for media in tweet['extended_entities']['media']:
+            if media['type'] == 'photo':
+                file_url = media['media_url_https']
+
+                path = download_image(file_url)
+                paths.append(path)
+            else:
+                file_url = self.best_variant(
+                    media['video_info'], bot.media_limits()["video_size"])
+
+                path = download_image(file_url)
+                paths.append(path)
+
+        handle = get_handle(tweet['user']['screen_name'])
+        name = tweet['user']['name']
+        # last word is always the shortened link to the media
+        if len(tweet['text'].rsplit(' ', 1)):
+            description = tweet['text'].rsplit(' ', 1)[0]
+        if tweet.get('possibly_sensitive'):
+            nsfw = True
+
+        image = {
+            "source": source,
+            "image_paths": paths,
+            "author": {
+                "handle": handle.strip(),
+                "name": name.strip()
+            },
+            "description": description.strip(),
+            "nsfw": nsfw
+        }
+        return image
+
+
+@register
+class DanbooruResolver(Resolver):
+    name = "danbooru"
+    pattern = re_danbooru
+
+    def fetch(self, bot, source):
+        if bot.danbooru_api:
+            id = source.split("/")[-1]
+            return bot.danbooru_api.post_show(id)
+        url = source + ".json"
+        resp = http_client.session.get(url)
+        return json.loads(resp.text)
+
+    def resolve(self, bot, source):
+        nsfw = False
+        paths = []
+        handle = ""
+        name = ""
+        description = ""
+        source = source.strip().split("?")[0]
+
+        id = self.pattern.search(source).group(1)
+        post = self.cached(bot, "post:" + id, lambda: self.fetch(bot, source))
+        logger.debug(post)
+
+        try:
+            file_url = 'http://danbooru.donmai.us' + \
+                post['file_url']
+        except KeyError:
+            file_url = post['source']
+        path = download_image(file_url)
+        paths.append(path)
+
+        # get name and handle if possible from pixiv, check if api
+        # shows pawoo handle
+        name = post['tag_string_artist']
+
+        if post['source']:
+            if re_link.search(parse.unquote(post['source'])):
+                source = parse.unquote(post['source'])
+            if re_tweet.search(source):
+                username = re_tweet.search(source).group(1)
+                handle = get_handle(username)
+        if post['pixiv_id'] and bot.pixiv_api:
+            source = "https://www.pixiv.net/member_illust.php?mode=medium&illust_id=" + \
+                str(post['pixiv_id'])
+            # only the author is needed, the image was already downloaded
+            pixiv = get_resolver("pixiv")
+            illust = pixiv.illust(bot, str(post['pixiv_id']))
+            author = pixiv.author(bot, illust['user'])
+            if author["handle"]:
+                handle = author["handle"]
+            if author["name"]:
+                name = author["name"]
+        if post['tag_string_copyright']:
+            description = '#' + \
+                post['tag_string_copyright'].replace(' ', ' #').replace(
+                    "#original", ' ').replace("_(series)", ' ').replace("-", "_")
+        if post['rating'] != "s":
+            nsfw = True
+
+        image = {
+            "source": source,
+            "image_paths": paths,
+            "author": {
+                "handle": handle.strip(),
+                "name": name.strip()
+            },
+            "description": description.strip(),
+            "nsfw": nsfw
+        }
+        return image
+
+
+@register
+class PixivResolver(Resolver):
+    name = "pixiv"
+    pattern = re_pixiv
+
+    def matches(self, bot, source):
+        # currently pixiv downloading only works while logged in to
+        # pixiv
+        return super().matches(bot, source) and bool(bot.pixiv_api)
+
+    def illust(self, bot, id):
+        return self.cached(
+            bot, "illust:" + id,
+            lambda: bot.pixiv_api.illust_detail(id, req_auth=True)['illust'])
+
+    def author(self, bot, user):
+        """
+        :param user: user dictionary of an illust
+        :return: dictionary with the name and the best handle of the user
+        """
+        def fetch():
+            handle = str(user['id'])
+            detail = bot.pixiv_api.user_detail(int(handle), req_auth=True)
+            if detail['profile']['twitter_account']:
+                username = detail['profile']['twitter_account']
+                handle = get_handle(username)
+            if detail['profile']['pawoo_url']:
+                # resolve redirected url
+                r = http_client.session.get(detail['profile']['pawoo_url'])
+                username = r.url.split("@")[1]
+                handle = get_handle(username, domain="pawoo.net")
+            return {"name": user['name'], "handle": handle}
+        return self.cached(bot, "user:" + str(user['id']), fetch)
+
+    def resolve(self, bot, source):
+        nsfw = False
+        paths = []
+        description = ""
+        source = source.strip()
+
+        id = self.pattern.search(source).group(2)
+        post = self.illust(bot, id)
+        logger.debug(post)
+
+        file_url = post['image_urls'][
+            'large'].replace("/c/600x1200_90", '')
+        # pixiv only serves images with a referer from its own app
+        path = download_image(
+            file_url, headers={'Referer': 'https://app-api.pixiv.net/'})
+        paths.append(path)
+
+        author = self.author(bot, post['user'])
+
+        description = post.get('title', "")
+        if post.get('tags'):
+            description += "\n\n"
+            for tag in post['tags']:
+                tag = tag['name'].replace(
+                    "/", "_").replace("-", "_")
+                description += '#' + tag + ' '
+            description = description[:-1]
+
+        image = {
+            "source": source,
+            "image_paths": paths,
+            "author": {
+                "handle": author["handle"].strip(),
+                "name": author["name"].strip()
+            },
+            "description": description.strip(),
+            "nsfw": nsfw
+        }
+        return image
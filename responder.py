@@ -0,0 +1,235 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger("bot")
+
+
+class RateLimit():
+    """
+    allows count events per key within a sliding window of seconds
+    """
+
+    def __init__(self, count, window):
+        self.count = count
+        self.window = window
+        self.lock = threading.Lock()
+        self.events = {}
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self.lock:
+            events = self.events.setdefault(key, deque())
+            while events and events[0] <= now - self.window:
+                events.popleft()
+            if len(events) >= self.count:
+                return False
+            events.append(now)
+            return True
+
+
+class Responder():
+    """
+    answers mentions from the streaming api with an image, mentioning
+    hashtags picks an image with all of these tags
+    """
+
+    # number of random images kept uploaded for the next replies
+    pool_size = 3
+    # replies per user within window seconds
+    limit = 3
+    window = 10 * 60
+    workers = 4
+
+    def __init__(self, bot):
+        """
+        :param bot: BotClass whose images are used for the replies
+        """
+        self.bot = bot
+        self.rate_limit = RateLimit(self.limit, self.window)
+        self.lock = threading.Lock()
+        self.refilling = threading.Lock()
+        # images with their uploaded media ids, ready to be attached
+        self.ready = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def candidates(self, tags):
+        """
+        :param tags: list of lowercase hashtags
+        :return: set of ids of images with all tags, None if no tags are given
+        """
+        if not tags:
+            return None
+        found = None
+        for tag in tags:
+            indices = self.bot.index.get("tag", tag)
+            found = set(indices) if found is None else found & indices
+        return set(index for index in found
+                   if not self.bot.is_boost(self.bot.db["images"].summary(index)))
+
+    def upload(self, index):
+        """
+        the media of replies is never shared with the scheduled toots
+        :param index: id of an image held for the reply
+        """
+        image = self.bot.db["images"][index]
+        return {"index": index,
+                "media_ids": self.bot.upload_media(image["image_paths"], cached=False),
+                "uploaded": time.time()}
+
+    def pick(self, candidates=None):
+        """
+        hold an image for a reply, so the scheduler doesn't pick it meanwhile
+        :param candidates: set of ids to pick from, None picks like the scheduler
+        :return: id of the held image or None
+        """
+        with self.bot.load_lock:
+            if candidates is None:
+                index = self.bot.selector.choose()
+                if index is None or self.bot.is_boost(self.bot.db["images"].summary(index)):
+                    return None
+            else:
+                free = sorted(candidates - self.bot.selector.held)
+                if not free:
+                    return None
+                index = random.choice(free)
+            self.bot.selector.hold(index)
+        return index
+
+    def release(self, index):
+        with self.bot.load_lock:
+            self.bot.selector.release(index)
+
+    def upload_held(self, index):
+        try:
+            return self.upload(index)
+        except BaseException:
+            self.release(index)
+            raise
+
+    def refill(self):
+        """
+        upload random images until the pool is full again, does nothing if
+        another thread is already refilling
+        """
+        if not self.refilling.acquire(blocking=False):
+            return
+        try:
+            tries = 0
+            while len(self.ready) < self.pool_size and tries < self.pool_size * 10:
+                tries += 1
+                index = self.pick()
+                if index is None:
+                    continue
+                entry = self.upload_held(index)
+                with self.lock:
+                    self.ready.append(entry)
+        except Exception as e:
+            logger.warning("couldn't upload images for replies: " + repr(e))
+        finally:
+            self.refilling.release()
+
+    def take(self, tags):
+        """
+        :param tags: list of lowercase hashtags the image should have
+        :return: dictionary with the id of an image and its media ids
+        """
+        candidates = self.candidates(tags)
+        if candidates is not None and not candidates:
+            logger.debug("no image tagged " + " ".join(tags))
+            candidates = None
+        with self.lock:
+            # mastodon deletes media that isn't attached to a toot after a while
+            expired = time.time() - self.bot.upload_ttl
+            while self.ready and self.ready[0]["uploaded"] < expired:
+                self.release(self.ready.popleft()["index"])
+            for entry in self.ready:
+                if candidates is None or entry["index"] in candidates:
+                    self.ready.remove(entry)
+                    return entry
+        index = self.pick(candidates)
+        if index is None and candidates is not None:
+            # every tagged image is being posted right now
+            index = self.pick()
+        if index is None:
+            return None
+        return self.upload_held(index)
+
+    def respond(self, notification):
+        if notification["type"] != "mention":
+            return
+        status = notification["status"]
+        account = status["account"]
+        # never answer other bots, they might answer back
+        if account.get("bot"):
+            return
+        if not self.rate_limit.allow(account["acct"]):
+            logger.info("not answering {}, too many mentions".format(account["acct"]))
+            return
+        tags = [tag["name"].lower() for tag in status.get("tags", [])]
+        entry = self.take(tags)
+        if entry is None:
+            logger.info("no image to answer {} with".format(account["acct"]))
+            return
+        try:
+            self.reply(status, entry)
+        finally:
+            self.release(entry["index"])
+        self.executor.submit(self.refill)
+
+    def reply(self, status, entry):
+        """
+        :param status: dictionary of the mentioning status
+        :param entry: dictionary from take
+        """
+        account = status["account"]
+        image = self.bot.db["images"][entry["index"]]
+        text = "@{} {}".format(account["acct"], self.bot.status_text(image))
+        # replies to direct messages stay direct
+        visibility = status["visibility"] if status["visibility"] == "direct" else "unlisted"
+        kwargs = {"in_reply_to_id": status["id"],
+                  "sensitive": image.get("nsfw", False),
+                  "visibility": visibility}
+        if image.get("cw"):
+            kwargs["spoiler_text"] = image["cw"]
+        try:
+            reply = self.bot.mastodon_api.status_post(
+                text, media_ids=entry["media_ids"], **kwargs)
+        except Exception as e:
+            # the instance might have deleted the media in the meantime
+            logger.debug("uploading again: " + repr(e))
+            entry = self.upload(entry["index"])
+            reply = self.bot.mastodon_api.status_post(
+                text, media_ids=entry["media_ids"], **kwargs)
+        logger.info("answered {}: {}".format(account["acct"], reply["url"]))
+
+    def handle(self, notification):
+        try:
+            self.respond(notification)
+        except Exception as e:
+            logger.warning("couldn't answer mention: " + repr(e))
+
+    def listen(self):
+        """
+        start answering mentions in the background
+        :return: handle of the stream, close it to stop
+        """
+        from mastodon import StreamListener
+        responder = self
+
+        class Listener(StreamListener):
+            def on_notification(self, notification):
+                # mentions are answered in parallel so bursts don't queue up
+                responder.executor.submit(responder.handle, notification)
+
+        self.refill()
+        logger.info("listening for mentions...")
+        return self.bot.mastodon_api.stream_user(
+            Listener(), run_async=True, reconnect_async=True)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
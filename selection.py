@@ -0,0 +1,158 @@
+import random
+from collections import deque
+
+
+class FenwickTree():
+    """
+    prefix sums over a list of weights, updating a weight and finding the
+    position of a prefix sum both take O(log n)
+    """
+
+    def __init__(self, weights=()):
+        self.weights = list(weights)
+        self.tree = [0.0] * (len(self.weights) + 1)
+        # build in O(n) by pushing every node into its parent
+        for i, weight in enumerate(self.weights, 1):
+            self.tree[i] += weight
+            parent = i + (i & -i)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[i]
+
+    def __len__(self):
+        return len(self.weights)
+
+    def append(self, weight):
+        # the new node covers the range (i - lowbit(i), i]
+        i = len(self.weights) + 1
+        self.weights.append(0.0)
+        self.tree.append(self.prefix(i - 1) - self.prefix(i - (i & -i)))
+        self.set(i - 1, weight)
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, count):
+        """
+        :return: sum of the first count weights
+        """
+        total = 0.0
+        while count > 0:
+            total += self.tree[count]
+            count -= count & -count
+        return total
+
+    def total(self):
+        return self.prefix(len(self.weights))
+
+    def find(self, value):
+        """
+        :param value: number between 0 and total()
+        :return: first index whose prefix sum including itself exceeds value
+        """
+        index = 0
+        step = 1 << len(self.weights).bit_length()
+        while step:
+            next_index = index + step
+            if next_index < len(self.tree) and self.tree[next_index] <= value:
+                index = next_index
+                value -= self.tree[next_index]
+            step >>= 1
+        return min(index, len(self.weights) - 1)
+
+
+class Selector():
+    """
+    picks random images proportional to their weight, recently posted
+    images are left out until they drop out of the no repeat window
+    """
+
+    def __init__(self, weight, no_repeat=0, seed=None):
+        """
+        :param weight: function returning the weight of an image dictionary
+                       and its id
+        :param no_repeat: number of recent picks that can't be picked again
+        :param seed: seed for the random generator, for reproducible picks
+        """
+        self.weight = weight
+        self.no_repeat = no_repeat
+        self.random = random.Random(seed)
+        self.recent = deque()
+        # images with a toot in progress
+        self.held = set()
+        # ids of the images that can be picked, None allows all
+        self.allowed = None
+        self.images = []
+        self.tree = FenwickTree()
+
+    def build(self, images):
+        """
+        :param images: list of all image dictionaries, kept as reference
+        """
+        self.images = images
+        recent = set(self.recent) | self.held
+        self.tree = FenwickTree(
+            self.weight(image, index) if self.pickable(index) and index not in recent else 0.0
+            for index, image in enumerate(images))
+
+    def pickable(self, index):
+        return self.allowed is None or index in self.allowed
+
+    def append(self, image):
+        index = len(self.tree)
+        self.tree.append(self.weight(image, index) if self.pickable(index) else 0.0)
+
+    def update(self, index):
+        if index in self.recent or index in self.held:
+            return
+        if self.pickable(index):
+            self.tree.set(index, self.weight(self.images[index], index))
+        else:
+            self.tree.set(index, 0.0)
+
+    def choose(self):
+        """
+        :return: id of the chosen image or None if no image can be picked
+        """
+        total = self.tree.total()
+        if total <= 0:
+            return None
+        index = self.tree.find(self.random.random() * total)
+        # rounding errors can land on an image without weight
+        for _ in range(len(self.tree)):
+            if self.tree.weights[index]:
+                return index
+            index = (index - 1) % len(self.tree)
+        return None
+
+    def hold(self, index):
+        """
+        keep an image from being picked while its toot is in progress
+        """
+        self.held.add(index)
+        if index < len(self.tree):
+            self.tree.set(index, 0.0)
+
+    def release(self, index):
+        self.held.discard(index)
+        if index < len(self.tree):
+            self.update(index)
+
+    def mark(self, index):
+        """
+        add a posted image to the no repeat window
+        :param index: id of the posted image
+        """
+        self.held.discard(index)
+        if not self.no_repeat:
+            self.update(index)
+            return
+        self.tree.set(index, 0.0)
+        self.recent.append(index)
+        while len(self.recent) > self.no_repeat:
+            released = self.recent.popleft()
+            self.update(released)
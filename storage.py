@@ -0,0 +1,448 @@
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # windows has no flock, writers aren't coordinated there
+    fcntl = None
+
+
+logger = logging.getLogger("bot")
+re_space = re.compile(r"[ \t\n\r]*")
+
+
+class FileLock():
+    """
+    exclusive lock on a file next to the db, held by one process at a time
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        # the thread holding the lock can enter it again
+        self.depth = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.file = open(self.path, 'a')
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+        self.lock.release()
+        return False
+
+
+class JsonStorage():
+    """
+    legacy backend, the whole db lives in a single json file
+    every write rewrites the complete file
+
+    only the position of every image in the file is kept, single images
+    are read from the loaded version of the file when they are needed
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # file of the loaded version, stays readable when it's replaced
+        self.file = None
+        # start and end byte of every image in the file
+        self.offsets = []
+        # hashes of the serialized images to find changed ones
+        self.hashes = []
+        self.stat = None
+        # a missing file can be loaded too, so the stat doesn't tell
+        self.loaded = False
+        # state found by changes, loaded once the caller confirms it
+        self.pending = None
+        self.read_lock = threading.Lock()
+        # other processes adding images write the same file
+        self.lock = FileLock(path + ".lock")
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _open(self):
+        """
+        :return: tuple with the open file or None, its content and its stat
+        """
+        with self.lock:
+            try:
+                file = open(self.path, 'rb')
+            except FileNotFoundError:
+                return None, b"", None
+            stat = os.fstat(file.fileno())
+            return file, file.read(), (stat.st_mtime_ns, stat.st_size)
+
+    def _scan(self, data):
+        """
+        parse the images one by one, so the dictionaries of all images
+        are never in memory at the same time, the decoded text of the
+        file is kept next to its bytes while scanning
+        :param data: bytes of the db file
+        :return: generator of tuples with an image, its start and end byte
+                 and the hash of its json
+        """
+        if not data.strip():
+            return
+        text = data.decode("utf-8")
+        # files written by json.dump are ascii, otherwise bytes are counted
+        ascii = len(text) == len(data)
+        decoder = json.JSONDecoder()
+        position = re_space.match(text, text.index("[", text.index('"images"')) + 1).end()
+        if text[position] == "]":
+            return
+        last = last_byte = 0
+        while True:
+            image, end = decoder.raw_decode(text, position)
+            if ascii:
+                start_byte, end_byte = position, end
+            else:
+                start_byte = last_byte + len(text[last:position].encode("utf-8"))
+                end_byte = start_byte + len(text[position:end].encode("utf-8"))
+                last, last_byte = end, end_byte
+            yield image, start_byte, end_byte, hash(text[position:end])
+            position = re_space.match(text, end).end()
+            if text[position] != ",":
+                return
+            position = re_space.match(text, position + 1).end()
+
+    def _replace(self, file, offsets, hashes, stat, loaded=True):
+        with self.read_lock:
+            self.loaded = loaded
+            if self.file is not None:
+                self.file.close()
+            self.file = file
+            self.offsets = offsets
+            self.hashes = hashes
+            self.stat = stat
+            self.pending = None
+
+    def changed(self):
+        """
+        :return: True if the file was modified since it was last loaded
+        """
+        return self._stat() != self.stat
+
+    def stream(self):
+        """
+        :return: generator of all images, the position is the image id,
+                 the file counts as loaded once the generator is done
+        """
+        file, data, stat = self._open()
+        offsets = []
+        hashes = []
+        for image, start, end, digest in self._scan(data):
+            offsets.append((start, end))
+            hashes.append(digest)
+            yield image
+        self._replace(file, offsets, hashes, stat)
+
+    def load(self):
+        """
+        :return: list of all images, the position in the list is the image id
+        """
+        return list(self.stream())
+
+    def changes(self):
+        """
+        the changes count as loaded once confirm is called
+        :return: list of (id, image) tuples of the images that were added or
+                 changed since the last load, None if a full load is needed
+        """
+        if not self.loaded:
+            return None
+        self.discard()
+        file, data, stat = self._open()
+        offsets = []
+        hashes = []
+        changes = []
+        for image, start, end, digest in self._scan(data):
+            index = len(offsets)
+            offsets.append((start, end))
+            hashes.append(digest)
+            if index >= len(self.hashes) or digest != self.hashes[index]:
+                changes.append((index, image))
+        if len(offsets) < len(self.hashes):
+            if file is not None:
+                file.close()
+            return None
+        self.pending = (file, offsets, hashes, stat)
+        return changes
+
+    def confirm(self):
+        """
+        mark the images returned by the last changes call as loaded
+        """
+        if self.pending is not None:
+            self._replace(*self.pending)
+
+    def discard(self):
+        """
+        forget the last changes, the next call returns them again
+        """
+        if self.pending is not None:
+            if self.pending[0] is not None:
+                self.pending[0].close()
+            self.pending = None
+
+    def get(self, index):
+        """
+        :return: stored dictionary of a single image
+        """
+        with self.read_lock:
+            start, end = self.offsets[index]
+            self.file.seek(start)
+            return json.loads(self.file.read(end - start))
+
+    def save(self, index, image):
+        """
+        :param index: id of the image
+        :param image: dictionary following schema/image.json
+        """
+        self.save_many([(index, image)])
+
+    def save_many(self, items):
+        self.write(items, [])
+
+    def append(self, images):
+        """
+        :param images: list of dictionaries following schema/image.json
+        :return: list with the ids of the new images
+        """
+        return self.write([], images)
+
+    def write(self, items, new):
+        with self.lock:
+            # keep what other processes wrote since the last load
+            others = self.changed()
+            file, data, stat = self._open()
+            spans = [(start, end) for image, start, end, digest in self._scan(data)]
+            if file is not None:
+                file.close()
+            changed = {index: json.dumps(image).encode() for index, image in items}
+            if changed and max(changed) >= len(spans):
+                raise IndexError(max(changed))
+            ids = list(range(len(spans), len(spans) + len(new)))
+            # unchanged images are written from the old bytes without copying them
+            view = memoryview(data)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'wb') as output:  # save to database
+                output.write(b'{"images": [')
+                for index, (start, end) in enumerate(spans):
+                    if index:
+                        output.write(b", ")
+                    output.write(changed.get(index) or view[start:end])
+                for index, image in zip(ids, new):
+                    if index:
+                        output.write(b", ")
+                    output.write(json.dumps(image).encode())
+                output.write(b"]}")
+            view.release()
+            os.replace(tmp_path, self.path)
+            # updates the caller already applied don't need to be loaded
+            # again, everything else is returned by the next changes call
+            if not others and not new:
+                self.changes()
+                self.confirm()
+        return ids
+
+    def close(self):
+        self.discard()
+        self._replace(None, [], [], None, loaded=False)
+
+
+class SqliteStorage():
+    """
+    every image is a single row, so adding an image or marking it as
+    posted only touches that row instead of rewriting the whole db
+
+    every write gets a new version number, so other processes only
+    have to load the rows with a higher version than they have seen
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        # wait for other processes that are writing
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "id INTEGER PRIMARY KEY, source TEXT NOT NULL, data TEXT NOT NULL, "
+            "version INTEGER NOT NULL DEFAULT 0)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(images)")]
+        if "version" not in columns:
+            logger.info("adding versions to the db")
+            self.connection.execute(
+                "ALTER TABLE images ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS images_version ON images (version)")
+        self.connection.commit()
+        # highest version and id that were loaded
+        self.version = None
+        # state found by changes, loaded once the caller confirms it
+        self.pending = None
+
+    def _state(self):
+        return self.connection.execute(
+            "SELECT (SELECT MAX(version) FROM images), (SELECT MAX(id) FROM images)").fetchone()
+
+    def changed(self):
+        """
+        :return: True if anything was written since the last load
+        """
+        with self.lock:
+            return self._state() != self.version
+
+    def stream(self):
+        """
+        :return: generator of all images, the position is the image id,
+                 the db counts as loaded once the generator is done
+        """
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            state = self._state()
+            for data, in self.connection.execute("SELECT data FROM images ORDER BY id"):
+                yield json.loads(data)
+        self.version = state
+        self.pending = None
+
+    def load(self):
+        """
+        :return: list of all images, the position in the list is the image id
+        """
+        return list(self.stream())
+
+    def changes(self):
+        """
+        the changes count as loaded once confirm is called
+        :return: list of (id, image) tuples of the images that were added or
+                 changed since the last load, None if a full load is needed
+        """
+        self.pending = None
+        if self.version is None:
+            return None
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN")
+            state = self._state()
+            if state[1] is None or (self.version[1] is not None and state[1] < self.version[1]):
+                # images were deleted
+                return None
+            rows = self.connection.execute(
+                "SELECT id, data FROM images WHERE version > ? ORDER BY id",
+                (self.version[0] or 0,)).fetchall()
+            self.pending = state
+        return [(index, json.loads(data)) for index, data in rows]
+
+    def confirm(self):
+        """
+        mark the images returned by the last changes call as loaded
+        """
+        if self.pending is not None:
+            self.version = self.pending
+            self.pending = None
+
+    def discard(self):
+        """
+        forget the last changes, the next call returns them again
+        """
+        self.pending = None
+
+    def get(self, index):
+        """
+        :return: stored dictionary of a single image
+        """
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT data FROM images WHERE id = ?", (index,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        return json.loads(row[0])
+
+    def save(self, index, image):
+        """
+        :param index: id of the image
+        :param image: dictionary following schema/image.json
+        """
+        self.save_many([(index, image)])
+
+    def save_many(self, items):
+        self.write(items, [])
+
+    def append(self, images):
+        """
+        ids are assigned within the transaction, so processes adding images
+        at the same time never get the same ids
+        :param images: list of dictionaries following schema/image.json
+        :return: list with the ids of the new images
+        """
+        return self.write([], images)
+
+    def write(self, items, new):
+        with self.lock, self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            state = self._state()
+            version = (state[0] or 0) + 1
+            start = 0 if state[1] is None else state[1] + 1
+            ids = list(range(start, start + len(new)))
+            items = list(items) + list(zip(ids, new))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO images (id, source, data, version) VALUES (?, ?, ?, ?)",
+                [(index, image["source"], json.dumps(image), version)
+                 for index, image in items])
+            # updates the caller already applied don't need to be loaded
+            # again, as long as nobody else wrote in between
+            if not new and state == self.version:
+                self.version = self._state()
+        return ids
+
+    def close(self):
+        self.connection.close()
+
+
+def open_storage(path):
+    """
+    :param path: path to the db, the extension decides which backend is used
+    :return: storage backend for the db
+    """
+    if path.endswith(".json"):
+        logger.debug("using json storage: " + path)
+        return JsonStorage(path)
+    logger.debug("using sqlite storage: " + path)
+    return SqliteStorage(path)
+
+
+def migrate(json_path, storage):
+    """
+    import an existing db.json into another storage backend
+    :param json_path: string with the path to the old db.json
+    :param storage: storage backend to import the images into
+    :return: number of imported images
+    """
+    with open(json_path) as data:
+        images = json.load(data)["images"]
+    existing = storage.load()
+    sources = set(image["source"] for image in existing)
+    # skip images that were already imported by a previous run
+    images = [image for image in images if image["source"] not in sources]
+    storage.append(images)
+    return len(images)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the bot's modules live in the top folder and are imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,66 @@
+import json
+import os
+
+import pytest
+
+from bot import BotClass
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def image(index, nsfw=False):
+    return {"source": "https://example.com/{}".format(index), "image_paths": ["a.png"],
+            "author": {"name": "artist"}, "description": "#tag", "nsfw": nsfw}
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    # the schemas are found relative to the repository
+    monkeypatch.chdir(root)
+    return {
+        "access_token": "token",
+        "client_id": "id",
+        "client_secret": "secret",
+        "domain": "https://mastodon.example",
+        "db_path": str(tmp_path / "db.sqlite"),
+        "offset_min": 10,
+        "selection": {"filter": "nsfw:false"}
+    }
+
+
+@pytest.fixture
+def bot(config):
+    bot = BotClass(config)
+    bot.add_image(image(0), image(1, nsfw=True), image(2))
+    yield bot
+    bot.storage.close()
+    bot.cache.close()
+
+
+def write(path, config):
+    with open(path, 'w') as data:
+        json.dump(config, data)
+
+
+def test_reload_applies_the_filter(bot, config, tmp_path):
+    assert bot.selector.allowed == {0, 2}
+    path = str(tmp_path / "config.json")
+    config["selection"] = {"filter": "nsfw:true"}
+    write(path, config)
+    bot.reload_config(path)
+    assert bot.selector.allowed == {1}
+
+
+@pytest.mark.parametrize("filter", ["nsfw:false tag", "nsfw:maybe", "color:red"])
+def test_invalid_filter_keeps_the_old_settings(bot, config, tmp_path, filter):
+    settings = bot.settings
+    query = bot.filter
+    path = str(tmp_path / "config.json")
+    config["selection"] = {"filter": filter, "no_repeat": 2}
+    write(path, config)
+    bot.reload_config(path)
+    assert bot.settings is settings
+    assert bot.filter == query
+    assert bot.selector.allowed == {0, 2}
+    assert bot.selector.no_repeat == 0
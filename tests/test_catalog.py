@@ -0,0 +1,107 @@
+from array import array
+
+import pytest
+
+from catalog import Catalog, SourceIndex
+
+
+images = [
+    {"source": "https://danbooru.donmai.us/posts/1", "image_paths": ["images/a.png"],
+     "description": "#touhou", "author": {"name": "artist", "handle": "@artist"},
+     "nsfw": False, "phashes": ["00ff00ff00ff00ff"]},
+    {"source": "https://twitter.com/a/status/1", "image_paths": ["a.png", "b.png"],
+     "author": {"name": "only a name"}, "nsfw": True, "cw": "spoiler",
+     "posted": "https://m.social/@bot/1",
+     "phashes": ["ffffffffffffffff", "0000000000000001"], "additional": ["https://x.y/z"]},
+    # fields the catalog doesn't know are kept as they are
+    {"source": "https://example.com/c.png", "image_paths": ["c.png"],
+     "author": {"name": "n", "url": "https://example.com"}, "custom": {"a": [1, 2]}},
+    {"source": "https://example.com/d.png", "image_paths": ["mastodon.png"], "description": ""},
+]
+
+
+@pytest.fixture
+def catalog():
+    catalog = Catalog(lambda index: images[index])
+    catalog.extend(images)
+    return catalog
+
+
+def test_images_come_back_unchanged(catalog):
+    assert len(catalog) == len(images)
+    for index, image in enumerate(images):
+        assert catalog[index] == image
+    assert catalog[-1] == images[-1]
+
+
+def test_iterating_leaves_out_descriptions(catalog):
+    expected = [{key: value for key, value in image.items() if key != "description"}
+                for image in images]
+    assert list(catalog) == expected
+    assert catalog.summary(0) == expected[0]
+
+
+def test_descriptions_are_loaded_when_needed():
+    loaded = []
+
+    def loader(index):
+        loaded.append(index)
+        return images[index]
+    catalog = Catalog(loader)
+    catalog.cache_size = 1
+    # appended descriptions are cached, the last one pushes out the first
+    catalog.extend(images)
+    assert loaded == []
+    assert catalog[0]["description"] == "#touhou"
+    assert loaded == [0]
+    # cached now
+    assert catalog[0]["description"] == "#touhou"
+    assert loaded == [0]
+
+
+def test_replacing_an_image(catalog):
+    changed = dict(images[0], posted="https://m.social/@bot/2", nsfw=True)
+    del changed["phashes"]
+    catalog[0] = changed
+    assert catalog[0] == changed
+    assert catalog[1] == images[1]
+
+
+def test_out_of_range(catalog):
+    with pytest.raises(IndexError):
+        catalog[len(images)]
+    with pytest.raises(IndexError):
+        catalog[len(images)] = images[0]
+
+
+def key(source):
+    return source.lower().rstrip("/")
+
+
+def test_source_index(catalog):
+    sources = SourceIndex(catalog, key)
+    sources.build()
+    assert len(sources) == len(images)
+    assert sources.get("https://twitter.com/a/status/1") == 1
+    assert "https://example.com/c.png" in sources
+    assert "https://example.com/missing.png" not in sources
+    # changed sources are removed before and added after the change
+    sources.remove(3)
+    catalog[3] = {"source": "https://Example.com/New/", "image_paths": ["d.png"]}
+    sources.add(3)
+    assert sources.get("https://example.com/d.png") is None
+    assert sources.get("https://example.com/new") == 3
+    catalog.append({"source": "https://example.com/new", "image_paths": ["e.png"]})
+    sources.add(4)
+    sources.remove(3)
+    assert sources.get("https://example.com/new") == 4
+
+
+def test_source_index_checks_the_catalog(catalog, monkeypatch):
+    sources = SourceIndex(catalog, key)
+    sources.build()
+    # every key has the same hash, so only the check tells them apart
+    sources.hashes = array('q', bytes(len(sources.hashes) * 8))
+    monkeypatch.setattr("builtins.hash", lambda value: 0)
+    assert sources.get("https://example.com/c.png") == 2
+    assert sources.get("https://example.com/missing.png") is None
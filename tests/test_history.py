@@ -0,0 +1,103 @@
+import json
+import multiprocessing
+import time
+
+import pytest
+
+from history import History
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "db.history.jsonl")
+
+
+def post(path, image, count):
+    history = History(path)
+    history.compact_every = 10 ** 9
+    for _ in range(count):
+        history.append(image, "https://m.social/@bot/1", False, 0.5)
+
+
+def test_counts_and_stats(path):
+    history = History(path)
+    history.append(1, "https://m.social/@bot/1", False, 2.0)
+    history.append(1, "https://m.social/@bot/2", True, 1.0)
+    history.append(2, "https://m.social/@bot/3", False, 0.5)
+    assert history.refresh() == {1, 2}
+    assert history.counts[1][0] == 2
+    stats = history.stats()
+    assert stats[1]["posts"] == 1 and stats[1]["boosts"] == 1
+    assert stats[1]["max_latency"] == 2.0
+    assert stats[2]["first"] == stats[2]["last"]
+
+
+def test_compaction_keeps_the_totals(path):
+    history = History(path)
+    for image in (1, 1, 2):
+        history.append(image, "https://m.social/@bot/1", False, 1.0)
+    before = history.stats()
+    history.keep = 0
+    history.compact()
+    assert open(path).read() == ""
+    assert history.stats() == before
+    # counts start over from the summary after a compaction
+    history.refresh()
+    assert history.counts[1][0] == 2
+    history.append(1, "https://m.social/@bot/2", False, 1.0)
+    assert history.refresh() == {1}
+    assert history.counts[1][0] == 3
+    assert History(path).counts[1][0] == 3
+
+
+def test_recent_entries_stay_in_the_log(path):
+    history = History(path)
+    history.append(1, "https://m.social/@bot/1", False, 1.0)
+    history.compact()
+    assert len(open(path).readlines()) == 1
+
+
+def test_half_written_lines_are_skipped(path):
+    history = History(path)
+    history.append(1, "https://m.social/@bot/1", False, 1.0)
+    with open(path, 'a') as log:
+        log.write('{"image": 2, "url"')
+    assert list(History(path).counts) == [1]
+    assert History(path).counts[1][0] == 1
+    assert set(History(path).stats()) == {1}
+
+
+def test_counts_include_other_processes(path):
+    history = History(path)
+    process = multiprocessing.Process(target=post, args=(path, 7, 3))
+    process.start()
+    process.join()
+    assert history.refresh() == {7}
+    assert history.counts[7][0] == 3
+
+
+def test_compacting_while_others_append_loses_nothing(path):
+    history = History(path)
+    history.keep = 0
+    processes = [multiprocessing.Process(target=post, args=(path, image, 100))
+                 for image in range(4)]
+    for process in processes:
+        process.start()
+    while any(process.is_alive() for process in processes):
+        history.compact()
+        time.sleep(0.01)
+    for process in processes:
+        process.join()
+    history.compact()
+    stats = History(path).stats()
+    assert {image: stats[image]["posts"] for image in stats} == {image: 100 for image in range(4)}
+
+
+def test_report_groups_by_source(path):
+    history = History(path)
+    for image in (1, 2, 2):
+        history.append(image, "https://m.social/@bot/1", False, 1.0)
+    sources, images = history.report(lambda index: "odd" if index % 2 else "even")
+    assert sources["odd"]["posts"] == 1 and sources["odd"]["images"] == 1
+    assert sources["even"]["posts"] == 2
+    assert json.dumps(sources)
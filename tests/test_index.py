@@ -0,0 +1,123 @@
+import pytest
+
+from index import ImageIndex, hashtags, keys, parse_query
+
+
+def image(source, description="", nsfw=False, handle=None, posted=None):
+    image = {"source": source, "image_paths": ["a.png"], "description": description,
+             "nsfw": nsfw, "author": {"name": "artist", "handle": handle}}
+    if posted:
+        image["posted"] = posted
+    return image
+
+
+@pytest.fixture
+def index():
+    images = [
+        image("https://danbooru.donmai.us/posts/1", "#Touhou #Reimu"),
+        image("https://twitter.com/a/status/1", "#touhou #marisa", nsfw=True, handle="@a"),
+        image("https://example.com/x.png", "#original", posted="https://m.social/@bot/1"),
+        image("https://danbooru.donmai.us/posts/2", "#original #touhou"),
+    ]
+    index = ImageIndex()
+    index.build(images)
+    return index
+
+
+def test_hashtags_are_lowercase():
+    assert hashtags("#Touhou and #reimu_hakurei!") == ["touhou", "reimu_hakurei"]
+    assert hashtags(None) == []
+
+
+def test_parse_query():
+    include, exclude = parse_query("tag:#Touhou tag:original nsfw:no -posted:true")
+    assert include == {"tag": {"touhou", "original"}, "nsfw": {"false"}}
+    assert exclude == {("posted", "true")}
+
+
+@pytest.mark.parametrize("query", ["foo:bar", "touhou", "tag:", "nsfw:maybe"])
+def test_parse_query_rejects_invalid_terms(query):
+    with pytest.raises(ValueError):
+        parse_query(query)
+
+
+def test_keys():
+    found = keys(image("https://twitter.com/a/status/1", "#A", handle="@Someone"))
+    assert ("tag", "a") in found
+    assert ("author", "someone") in found
+    assert ("nsfw", "false") in found
+    assert ("posted", "false") in found
+    assert ("source", "twitter") in found
+
+
+def test_values_of_the_same_field_match_any(index):
+    assert index.query("tag:reimu tag:marisa") == {0, 1}
+
+
+def test_fields_all_have_to_match(index):
+    assert index.query("tag:touhou nsfw:false") == {0, 3}
+    assert index.query("tag:touhou tag:original source:danbooru") == {0, 3}
+    assert index.query("tag:missing nsfw:false") == set()
+
+
+def test_excluded_terms(index):
+    assert index.query("-tag:touhou") == {2}
+    assert index.query("tag:original -posted:true") == {3}
+
+
+def test_remove_and_add_after_a_change(index):
+    changed = image("https://example.com/x.png", "#original", posted="https://m.social/@bot/1")
+    index.remove(2, changed)
+    changed["description"] = "#touhou"
+    index.add(2, changed)
+    assert index.query("tag:touhou") == {0, 1, 2, 3}
+    assert index.query("tag:original") == {3}
+
+
+def test_remove_without_the_description(index):
+    old = image("https://twitter.com/a/status/1", nsfw=True, handle="@a")
+    del old["description"]
+    index.remove(1, old)
+    assert index.query("tag:marisa") == set()
+    assert ("tag", "marisa") not in index.postings
+    assert ("author", "a") not in index.postings
+    assert index.get("tag", "touhou") == {0, 3}
+    assert index.query("nsfw:true") == set()
+    assert index.query("-posted:true") == {0, 3}
+
+
+def test_dense_fields(index):
+    assert index.get("nsfw", True) == {1}
+    assert index.get("source", "danbooru") == {0, 3}
+    assert index.query("source:danbooru source:other") == {0, 2, 3}
+    assert index.query("-source:danbooru -nsfw:true") == {2}
+    assert index.values("source") == {"danbooru": 2, "twitter": 1, "other": 1}
+    assert index.values("posted") == {"true": 1, "false": 3}
+
+
+def test_gaps_match_nothing():
+    index = ImageIndex()
+    index.add(3, image("https://example.com/x.png", "#original"))
+    assert index.size == 4
+    assert index.query("-tag:touhou") == {3}
+    assert index.query("nsfw:false") == {3}
+
+
+def test_ids_stay_sorted():
+    index = ImageIndex()
+    for position in (5, 1, 3, 1):
+        index.add(position, image("https://example.com/{}".format(position), "#a"))
+    assert list(index.postings[("tag", "a")]) == [1, 3, 5]
+    index.remove(3, image("https://example.com/3", "#a"))
+    assert list(index.postings[("tag", "a")]) == [1, 5]
+
+
+def test_values_count_the_images(index):
+    assert index.values("tag") == {"touhou": 3, "reimu": 1, "marisa": 1, "original": 2}
+
+
+def test_matches_agrees_with_query(index):
+    query = parse_query("tag:touhou -nsfw:true")
+    assert index.matches(query, image("https://a.b/c", "#touhou"))
+    assert not index.matches(query, image("https://a.b/c", "#touhou", nsfw=True))
+    assert not index.matches(query, image("https://a.b/c", "#other"))
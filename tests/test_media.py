@@ -0,0 +1,208 @@
+import hashlib
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import requests
+
+import http_client
+from bench import FakeHandler, FakeServer, LocalAdapter, png
+from media import MediaStore, PerceptualIndex
+
+
+def flip(value, count, rng):
+    for bit in rng.sample(range(64), count):
+        value ^= 1 << bit
+    return value
+
+
+def brute_force(hashes, value, distance):
+    for other, index in hashes:
+        if bin(value ^ other).count("1") <= distance:
+            return index
+    return None
+
+
+@pytest.mark.parametrize("distance", [0, 1, 4, 8, 15, 16, 20])
+def test_perceptual_index_matches_a_linear_scan(distance):
+    rng = random.Random(distance)
+    bases = [rng.getrandbits(64) for _ in range(20)]
+    hashes = []
+    phashes = PerceptualIndex()
+    for index in range(400):
+        # hashes around a few bases, some right at the distance
+        value = flip(rng.choice(bases), rng.randint(0, distance + 2), rng)
+        hashes.append((value, index))
+        phashes.add("{:016x}".format(value), index)
+    for base in bases:
+        for count in (distance - 1, distance, distance + 1):
+            if count < 0:
+                continue
+            value = flip(base, count, rng)
+            assert phashes.find("{:016x}".format(value), distance) == \
+                brute_force(hashes, value, distance)
+
+
+def test_perceptual_index_threshold():
+    phashes = PerceptualIndex()
+    phashes.add("0000000000000000", 0)
+    assert phashes.find("000000000000000f", 4) == 0
+    assert phashes.find("000000000000001f", 4) is None
+    # hashes added after the tables were built are found as well
+    phashes.add("00000000000000ff", 1)
+    assert phashes.find("00000000000001ff", 1) == 1
+
+
+class FaultyHandler(FakeHandler):
+    """
+    fails file requests in the ways listed in server.faults
+    """
+
+    def handle_request(self):
+        self.server.log.append(dict(self.headers))
+        super().handle_request()
+
+    do_GET = handle_request
+
+    def send_file(self, data, content_type):
+        fault = self.server.faults.pop(0) if self.server.faults else None
+        if fault == "truncate":
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("ETag", '"{}"'.format(hashlib.sha1(data).hexdigest()))
+            self.end_headers()
+            self.wfile.write(data[:len(data) // 2])
+            self.close_connection = True
+        elif fault == "range":
+            self.send_response(206)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Range", "bytes 0-{}/{}".format(
+                len(data) - 1, len(data)))
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif fault == "missing":
+            self.send_json({"error": "not found"}, status=404)
+        else:
+            super().send_file(data, content_type)
+
+
+@pytest.fixture(scope="module")
+def server():
+    server = FakeServer(handler=FaultyHandler)
+    server.files.clear()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(server, tmp_path, monkeypatch):
+    server.log = []
+    server.faults = []
+    session = http_client.Session(retries=0)
+    adapter = LocalAdapter("{}:{}".format(*server.server_address))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    monkeypatch.setattr(http_client, "session", session)
+    return MediaStore(str(tmp_path / "images"))
+
+
+def part(store, url):
+    return os.path.join(store.tmp, hashlib.sha1(url.encode()).hexdigest() + ".part")
+
+
+def etag(data):
+    return '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+
+def content(path):
+    with open(path, 'rb') as data:
+        return data.read()
+
+
+def test_download(server, store):
+    url = "https://files.bench/plain.png"
+    path = store.download(url)
+    assert content(path) == server.file("plain.png")
+    assert path == store.path(hashlib.sha256(content(path)).hexdigest(), ".png")
+    assert os.listdir(store.tmp) == []
+
+
+def test_resume_partial_file(server, store):
+    url = "https://files.bench/resume.png"
+    data = server.file("resume.png")
+    os.makedirs(store.tmp)
+    with open(part(store, url), 'wb') as out_file:
+        out_file.write(data[:1000])
+    with open(part(store, url) + ".validator", 'w') as out_file:
+        out_file.write(etag(data))
+    path = store.download(url)
+    assert content(path) == data
+    assert server.log[0]["Range"] == "bytes=1000-"
+    assert server.log[0]["If-Range"] == etag(data)
+    assert os.listdir(store.tmp) == []
+
+
+def test_changed_file_starts_over(server, store):
+    url = "https://files.bench/changed.png"
+    data = server.file("changed.png")
+    os.makedirs(store.tmp)
+    with open(part(store, url), 'wb') as out_file:
+        out_file.write(b"old content of the file")
+    with open(part(store, url) + ".validator", 'w') as out_file:
+        out_file.write('"old"')
+    path = store.download(url)
+    # the validator doesn't match, so the server sent the whole file
+    assert len(server.log) == 1
+    assert content(path) == data
+
+
+def test_mismatched_range_starts_over(server, store):
+    url = "https://files.bench/range.png"
+    data = server.file("range.png")
+    os.makedirs(store.tmp)
+    with open(part(store, url), 'wb') as out_file:
+        out_file.write(data[:1000])
+    with open(part(store, url) + ".validator", 'w') as out_file:
+        out_file.write(etag(data))
+    server.faults = ["range"]
+    path = store.download(url)
+    assert content(path) == data
+    assert len(server.log) == 2
+    assert "Range" not in server.log[1]
+
+
+def test_truncated_body_is_resumed(server, store):
+    url = "https://files.bench/truncated.png"
+    # the chunks read before the connection broke are kept
+    data = server.files["truncated.png"] = png("truncated.png", size=512)
+    server.faults = ["truncate"]
+    path = store.download(url)
+    assert content(path) == data
+    assert len(server.log) == 2
+    offset = int(server.log[1]["Range"][6:-1])
+    assert 0 < offset <= len(data) // 2
+    assert offset % store.chunk_size == 0
+
+
+def test_failed_download_leaves_no_partial_file(server, store):
+    server.faults = ["missing"]
+    with pytest.raises(requests.HTTPError):
+        store.download("https://files.bench/missing.png")
+    assert os.listdir(store.tmp) == []
+
+
+def test_concurrent_downloads(server, store):
+    url = "https://files.bench/concurrent.png"
+    server.latency = 0.2
+    try:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            paths = list(executor.map(store.download, [url, url]))
+    finally:
+        server.latency = 0
+    assert paths[0] == paths[1]
+    assert content(paths[0]) == server.file("concurrent.png")
+    assert os.listdir(store.tmp) == []
@@ -0,0 +1,137 @@
+import asyncio
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import outbox
+from bot import BotClass
+from outbox import Outbox
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "cache.sqlite")
+
+
+def toot(state="selected", index=1):
+    return {"index": index, "state": state, "boost": False}
+
+
+def test_states_are_in_order():
+    assert outbox.states == ("selected", "uploaded", "posted", "recorded")
+
+
+def test_steps_are_saved(path):
+    box = Outbox(path)
+    id = box.add(toot(), delay=100)
+    entry = box.pending()[0]
+    assert entry["id"] == id and entry["state"] == "selected"
+    entry["state"] = "uploaded"
+    entry["media_ids"] = [1, 2]
+    box.update(id, entry)
+    # another process sees the saved step
+    entry = Outbox(path).pending()[0]
+    assert entry["state"] == "uploaded" and entry["media_ids"] == [1, 2]
+    box.remove(id)
+    assert box.pending() == []
+
+
+def test_new_toots_are_not_due(path):
+    box = Outbox(path)
+    box.add(toot(), delay=100)
+    assert box.pending(before=time.time()) == []
+    assert box.next_try() > time.time() + 50
+
+
+def test_failed_toots_are_tried_again_after_the_delay(path):
+    box = Outbox(path)
+    id = box.add(toot(), delay=100)
+    box.failed(id, "error", 0)
+    assert box.attempts(id) == 1
+    assert [entry["id"] for entry in box.pending(before=time.time())] == [id]
+    box.failed(id, "error", 100)
+    assert box.attempts(id) == 2
+    assert box.pending(before=time.time()) == []
+
+
+def test_toots_of_other_processes_are_not_claimed(path):
+    working = Outbox(path)
+    other = Outbox(path)
+    id = working.add(toot(), delay=100)
+    assert not other.claim(id)
+    # resuming doesn't make toots due that are still worked on
+    other.resume()
+    assert other.pending(before=time.time()) == []
+    assert working.claim(id)
+
+
+def test_failed_toots_can_be_claimed_by_anyone(path):
+    working = Outbox(path)
+    other = Outbox(path)
+    id = working.add(toot(), delay=100)
+    working.failed(id, "error", 0)
+    assert other.claim(id)
+    assert not working.claim(id)
+
+
+def test_toots_of_crashed_processes_are_resumed(path):
+    crashed = Outbox(path)
+    crashed.lease_time = -1
+    id = crashed.add(toot(), delay=100)
+    other = Outbox(path)
+    other.resume()
+    assert [entry["id"] for entry in other.pending(before=time.time())] == [id]
+    assert other.claim(id)
+
+
+def test_renewed_leases_stay_with_the_process(path):
+    working = Outbox(path)
+    working.lease_time = -1
+    id = working.add(toot(), delay=100)
+    working.lease_time = 100
+    working.renew([id])
+    assert not Outbox(path).claim(id)
+
+
+def test_tables_are_separate(path):
+    first = Outbox(path, table="first")
+    second = Outbox(path, table="second")
+    first.add(toot())
+    assert second.pending() == []
+
+
+def test_retry_loop_survives_outbox_errors(path, monkeypatch):
+    box = Outbox(path)
+    id = box.add(toot(), delay=-1)
+    resume = box.resume
+    errors = [sqlite3.OperationalError("database is locked")]
+
+    def flaky_resume():
+        if errors:
+            raise errors.pop()
+        resume()
+
+    advanced = []
+    bot = SimpleNamespace(outbox=box, active=set(), advance_toot=advanced.append)
+    monkeypatch.setattr(box, "resume", flaky_resume)
+    sleep = asyncio.sleep
+
+    async def no_wait(seconds):
+        await sleep(0)
+
+    async def retry():
+        task = asyncio.ensure_future(BotClass.retry_toots(bot))
+        while not advanced and not task.done():
+            await sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return task
+
+    monkeypatch.setattr(asyncio, "sleep", no_wait)
+    task = asyncio.run(retry())
+    # the loop went on after the error and retried the due toot
+    assert not errors
+    assert advanced[0]["id"] == id
+    assert task.cancelled()
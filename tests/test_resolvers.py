@@ -0,0 +1,92 @@
+from types import SimpleNamespace
+
+import pytest
+
+import resolvers
+from resolvers import Resolver, find_resolver, get_resolver, register
+
+
+class FakeCache():
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.data[key] = value
+        self.ttls[key] = ttl
+
+
+def fake_bot(**apis):
+    return SimpleNamespace(cache=FakeCache(), tweet_api=apis.get("tweet_api"),
+                           pixiv_api=apis.get("pixiv_api"),
+                           danbooru_api=apis.get("danbooru_api"))
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = list(resolvers.registry)
+    monkeypatch.setattr(resolvers, "registry", registry)
+    return registry
+
+
+def test_registry_order():
+    assert [resolver.name for resolver in resolvers.registry] == \
+        ["mastodon", "twitter", "danbooru", "pixiv"]
+
+
+def test_find_resolver():
+    bot = fake_bot()
+    assert find_resolver(bot, "https://mastodon.social/@a/1").name == "mastodon"
+    assert find_resolver(bot, "https://danbooru.donmai.us/posts/1").name == "danbooru"
+    # twitter and pixiv need their apis
+    assert find_resolver(bot, "https://twitter.com/a/status/1") is None
+    bot = fake_bot(tweet_api=object())
+    assert find_resolver(bot, "https://twitter.com/a/status/1").name == "twitter"
+    assert find_resolver(bot, "https://example.com/a.png") is None
+
+
+def test_first_registered_resolver_wins(registry):
+    @register
+    class Everything(Resolver):
+        name = "everything"
+
+        def matches(self, bot, source):
+            return True
+
+        def resolve(self, bot, source):
+            return None
+
+    bot = fake_bot()
+    assert registry[-1].name == "everything"
+    assert find_resolver(bot, "https://danbooru.donmai.us/posts/1").name == "danbooru"
+    assert find_resolver(bot, "https://example.com/a.png").name == "everything"
+    assert get_resolver("everything") is registry[-1]
+
+
+def test_resolver_has_to_implement_resolve():
+    class Incomplete(Resolver):
+        name = "incomplete"
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_cached_hit_skips_fetch():
+    bot = fake_bot()
+    resolver = get_resolver("danbooru")
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        return {"id": 1}
+
+    assert resolver.cached(bot, "post:1", fetch) == {"id": 1}
+    assert resolver.cached(bot, "post:1", fetch) == {"id": 1}
+    assert len(calls) == 1
+    assert bot.cache.ttls == {"meta:danbooru:post:1": resolver.ttl}
+    # keys are per resolver
+    get_resolver("pixiv").cached(bot, "post:1", fetch)
+    assert len(calls) == 2
@@ -0,0 +1,102 @@
+import random
+
+import pytest
+
+from selection import FenwickTree, Selector
+
+
+def weight(image, index=None):
+    return image["weight"]
+
+
+def images(*weights):
+    return [{"weight": value} for value in weights]
+
+
+def test_prefix_sums_match_the_weights():
+    weights = [random.Random(1).random() for _ in range(37)]
+    tree = FenwickTree(weights)
+    for count in range(len(weights) + 1):
+        assert tree.prefix(count) == pytest.approx(sum(weights[:count]))
+
+
+def test_append_and_set_keep_the_sums():
+    tree = FenwickTree()
+    weights = []
+    for value in range(1, 20):
+        tree.append(float(value))
+        weights.append(float(value))
+    tree.set(4, 0.0)
+    weights[4] = 0.0
+    assert tree.total() == pytest.approx(sum(weights))
+    for count in range(len(weights) + 1):
+        assert tree.prefix(count) == pytest.approx(sum(weights[:count]))
+
+
+def test_find_returns_the_position_of_a_prefix_sum():
+    tree = FenwickTree([1.0, 0.0, 2.0, 3.0])
+    assert tree.find(0.5) == 0
+    assert tree.find(1.0) == 2
+    assert tree.find(2.9) == 2
+    assert tree.find(3.0) == 3
+    assert tree.find(5.9) == 3
+
+
+def test_choose_follows_the_weights():
+    selector = Selector(weight, seed=1)
+    selector.build(images(1, 0, 3))
+    picks = [selector.choose() for _ in range(4000)]
+    assert 1 not in picks
+    assert picks.count(2) / picks.count(0) == pytest.approx(3, rel=0.15)
+
+
+def test_choose_without_weights_returns_none():
+    selector = Selector(weight)
+    selector.build(images(0, 0))
+    assert selector.choose() is None
+    selector.build([])
+    assert selector.choose() is None
+
+
+def test_no_repeat_leaves_out_recent_picks():
+    selector = Selector(weight, no_repeat=2, seed=1)
+    selector.build(images(1, 1, 1))
+    selector.mark(0)
+    selector.mark(1)
+    assert {selector.choose() for _ in range(50)} == {2}
+    # the oldest pick drops out of the window
+    selector.mark(2)
+    assert {selector.choose() for _ in range(50)} == {0}
+
+
+def test_held_images_are_not_picked_until_released():
+    selector = Selector(weight, seed=1)
+    selector.build(images(1, 1))
+    selector.hold(0)
+    assert {selector.choose() for _ in range(50)} == {1}
+    selector.release(0)
+    assert {selector.choose() for _ in range(200)} == {0, 1}
+
+
+def test_allowed_limits_the_picks():
+    selector = Selector(weight, seed=1)
+    selector.allowed = {1}
+    shown = images(1, 1, 1)
+    selector.build(shown)
+    assert {selector.choose() for _ in range(50)} == {1}
+    # the selector keeps a reference, new images are appended to the list first
+    shown.append({"weight": 1})
+    selector.append(shown[-1])
+    assert {selector.choose() for _ in range(50)} == {1}
+    selector.allowed.add(3)
+    selector.update(3)
+    assert {selector.choose() for _ in range(200)} == {1, 3}
+
+
+def test_same_seed_picks_the_same_images():
+    picks = []
+    for _ in range(2):
+        selector = Selector(weight, seed=42)
+        selector.build(images(*range(1, 30)))
+        picks.append([selector.choose() for _ in range(20)])
+    assert picks[0] == picks[1]
@@ -0,0 +1,149 @@
+import json
+import multiprocessing
+import sqlite3
+
+import pytest
+
+import storage
+from storage import JsonStorage, SqliteStorage, migrate, open_storage
+
+
+def image(number):
+    return {"source": "https://example.com/{}".format(number), "image_paths": ["a.png"],
+            "author": {"name": "artist ä"}, "description": "#tag"}
+
+
+@pytest.fixture(params=["db.sqlite", "db.json"])
+def path(request, tmp_path):
+    return str(tmp_path / request.param)
+
+
+def append(path, start):
+    return open_storage(path).append([image(number) for number in range(start, start + 5)])
+
+
+def test_backend_by_extension(tmp_path):
+    assert isinstance(open_storage(str(tmp_path / "db.json")), JsonStorage)
+    assert isinstance(open_storage(str(tmp_path / "db.sqlite")), SqliteStorage)
+
+
+def test_append_save_and_load(path):
+    db = open_storage(path)
+    assert db.load() == []
+    assert db.append([image(0), image(1)]) == [0, 1]
+    assert db.append([image(2)]) == [2]
+    changed = dict(image(1), posted="https://m.social/@bot/1")
+    db.save(1, changed)
+    assert open_storage(path).load() == [image(0), changed, image(2)]
+
+
+def test_get_reads_single_images(path):
+    db = open_storage(path)
+    db.append([image(0), image(1)])
+    db.load()
+    assert db.get(1) == image(1)
+
+
+def test_nothing_changed_after_own_updates(path):
+    db = open_storage(path)
+    db.append([image(0)])
+    db.load()
+    assert not db.changed()
+    db.save(0, dict(image(0), posted="https://m.social/@bot/1"))
+    assert not db.changed()
+
+
+def test_changes_of_other_writers(path):
+    db = open_storage(path)
+    db.append([image(0), image(1)])
+    db.load()
+    other = open_storage(path)
+    other.load()
+    changed = dict(image(0), posted="https://m.social/@bot/1")
+    other.save(0, changed)
+    other.append([image(2)])
+    assert db.changed()
+    assert db.changes() == [(0, changed), (2, image(2))]
+    db.confirm()
+    assert not db.changed()
+    assert db.get(2) == image(2)
+
+
+def test_unconfirmed_changes_are_returned_again(path):
+    db = open_storage(path)
+    db.load()
+    open_storage(path).append([image(0)])
+    assert db.changes() == [(0, image(0))]
+    db.discard()
+    assert db.changed()
+    assert db.changes() == [(0, image(0))]
+
+
+def test_changes_before_the_first_load_need_a_full_load(path):
+    db = open_storage(path)
+    db.append([image(0)])
+    assert db.changes() is None
+
+
+def test_appends_of_several_processes_get_different_ids(path):
+    open_storage(path).load()
+    with multiprocessing.Pool(4) as pool:
+        ids = pool.starmap(append, [(path, start) for start in range(0, 40, 5)])
+    assert sorted(sum(ids, [])) == list(range(40))
+    images = open_storage(path).load()
+    assert sorted(image["source"] for image in images) == \
+        sorted(image(number)["source"] for number in range(40))
+
+
+def test_deleted_images_need_a_full_load(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    db = SqliteStorage(path)
+    db.append([image(0), image(1)])
+    db.load()
+    other = SqliteStorage(path)
+    other.connection.execute("DELETE FROM images WHERE id = 1")
+    other.connection.commit()
+    assert db.changes() is None
+
+
+def test_old_sqlite_dbs_get_versions(tmp_path):
+    path = str(tmp_path / "db.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE images (id INTEGER PRIMARY KEY, "
+                       "source TEXT NOT NULL, data TEXT NOT NULL)")
+    connection.execute("INSERT INTO images VALUES (0, ?, ?)",
+                       (image(0)["source"], json.dumps(image(0))))
+    connection.commit()
+    connection.close()
+    db = SqliteStorage(path)
+    assert db.load() == [image(0)]
+    assert db.append([image(1)]) == [1]
+
+
+def test_legacy_json_files(tmp_path):
+    path = str(tmp_path / "db.json")
+    with open(path, 'w', encoding="utf-8") as data:
+        json.dump({"images": [image(0), image(1)]}, data, indent=4, ensure_ascii=False)
+    db = JsonStorage(path)
+    assert db.load() == [image(0), image(1)]
+    assert db.get(1) == image(1)
+    db.save(0, image(5))
+    assert JsonStorage(path).load() == [image(5), image(1)]
+
+
+def test_migrate_skips_imported_images(tmp_path):
+    json_path = str(tmp_path / "db.json")
+    with open(json_path, 'w') as data:
+        json.dump({"images": [image(0), image(1)]}, data)
+    db = SqliteStorage(str(tmp_path / "db.sqlite"))
+    assert migrate(json_path, db) == 2
+    assert migrate(json_path, db) == 0
+    assert db.load() == [image(0), image(1)]
+
+
+def test_file_lock_can_be_entered_again(tmp_path):
+    lock = storage.FileLock(str(tmp_path / "lock"))
+    with lock:
+        with lock:
+            pass
+    assert lock.depth == 0
@@ -0,0 +1,36 @@
+import threading
+
+import pytest
+
+import watcher
+from watcher import Watcher, sqlite_files
+
+
+def wait_for_change(tmp_path, **kwargs):
+    path = tmp_path / "config.json"
+    path.write_text("{}")
+    changed = threading.Event()
+    files = Watcher(**kwargs)
+    files.watch(str(path), lambda path: changed.set())
+    files.start()
+    try:
+        # give the thread time to take its first look
+        threading.Event().wait(0.3)
+        path.write_text('{"offset_min": 5}')
+        return changed.wait(5)
+    finally:
+        files.stop()
+
+
+def test_polling_sees_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(watcher, "INotify", None)
+    assert wait_for_change(tmp_path, interval=0.1)
+
+
+@pytest.mark.skipif(watcher.INotify is None, reason="inotify_simple isn't installed")
+def test_inotify_sees_changes(tmp_path):
+    assert wait_for_change(tmp_path)
+
+
+def test_sqlite_files_include_the_log():
+    assert sqlite_files("db.sqlite") == ["db.sqlite", "db.sqlite-wal"]
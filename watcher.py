@@ -0,0 +1,103 @@
+import logging
+import os
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+
+logger = logging.getLogger("bot")
+
+
+class Watcher():
+    """
+    calls a function when a watched file changes, uses inotify if
+    inotify_simple is installed and checks the files periodically otherwise
+    """
+
+    def __init__(self, interval=2, delay=0.2):
+        """
+        :param interval: seconds between two checks without inotify
+        :param delay: seconds to wait for more changes before calling back,
+                      so a burst of writes only causes one call
+        """
+        self.interval = interval
+        self.delay = delay
+        self.callbacks = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def watch(self, path, callback):
+        """
+        :param path: string with the path to the file
+        :param callback: function called with the path after the file changed
+        """
+        self.callbacks[os.path.abspath(path)] = callback
+
+    def start(self):
+        if INotify is not None:
+            target = self.notify
+        else:
+            logger.debug("inotify_simple isn't installed, checking files every {}s".format(
+                self.interval))
+            target = self.poll
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def run_callbacks(self, paths):
+        for path in paths:
+            try:
+                self.callbacks[path](path)
+            except Exception as e:
+                logger.warning("couldn't reload {}: {}".format(path, repr(e)))
+
+    def stat(self, path):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def poll(self):
+        stats = {path: self.stat(path) for path in self.callbacks}
+        while not self.stopping.wait(self.interval):
+            changed = []
+            for path in self.callbacks:
+                stat = self.stat(path)
+                if stat != stats[path]:
+                    stats[path] = stat
+                    changed.append(path)
+            self.run_callbacks(changed)
+
+    def notify(self):
+        inotify = INotify()
+        # editors and atomic writes replace files, so their folders are
+        # watched instead of the files themselves
+        folders = {}
+        mask = flags.CLOSE_WRITE | flags.MODIFY | flags.MOVED_TO | flags.CREATE
+        for path in self.callbacks:
+            folder = os.path.dirname(path)
+            if folder not in folders.values():
+                folders[inotify.add_watch(folder, mask)] = folder
+        with inotify:
+            while not self.stopping.is_set():
+                changed = set()
+                for event in inotify.read(timeout=1000, read_delay=self.delay * 1000):
+                    path = os.path.join(folders[event.wd], event.name)
+                    if path in self.callbacks:
+                        changed.add(path)
+                self.run_callbacks(sorted(changed))
+
+
+def sqlite_files(path):
+    """
+    :return: list with the db and its write ahead log, writes to a sqlite
+             db in wal mode only touch the log until a checkpoint
+    """
+    return [path, path + "-wal"]
+